@@ -3,18 +3,31 @@ import sys
 import os
 import platform
 import collections
-import contextlib
 import json
 import tempfile
 import socket
 import stat
-from ftplib import FTP, error_perm
+import time
+import calendar
+import shlex
+import fnmatch
+import tarfile
+import queue
+import threading
+from ftplib import FTP, error_perm, error_proto, error_temp
 from .pathlib import Path, PurePosixPath
 from datetime import datetime
 from .dlg import *
+from .pool import ConnectionPool, is_too_many_connections
+from .cache import ListingCache, FileCache, file_hashes, changed_ranges
+from .engine import engine, is_main_thread, check_cancelled, current_task, Cancelled
+from .engine import sleep as sleep_cancellable, in_task, SubTask
+from .transfers import TransferQueue, Batch, FAILED, CANCELLED
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import base64
 import math
+import io
 
 #for Windows, use portable installation of Paramiko+others
 v = sys.version_info
@@ -63,6 +76,31 @@ def init_log():
     app_proc(PROC_BOTTOMPANEL_ADD_DIALOG, (TITLE_LOG, h_dlg, 'ftp log.png'))
 
 
+TITLE_TRANSFERS = _("FTP Transfers")
+handle_transfers = 0
+
+def init_transfers():
+    global handle_transfers
+    if handle_transfers: return
+
+    h_dlg = dlg_proc(0, DLG_CREATE)
+
+    n = dlg_proc(h_dlg, DLG_CTL_ADD, prop='listbox_ex')
+    dlg_proc(h_dlg, DLG_CTL_PROP_SET, index=n, prop={
+        'name':'list',
+        'a_r':('',']'), #anchor to entire form: l,r,t,b
+        'a_b':('',']'),
+        'on_menu': 'cuda_ftp.transfers_on_menu',
+        } )
+
+    handle_transfers = dlg_proc(h_dlg, DLG_CTL_HANDLE, index=n)
+
+    dlg_proc(h_dlg, DLG_SCALE)
+    listbox_proc(handle_transfers, LISTBOX_THEME) #THEME after DLG_SCALE
+
+    app_proc(PROC_BOTTOMPANEL_ADD_DIALOG, (TITLE_TRANSFERS, h_dlg, 'ftp log.png'))
+
+
 # Show ftp exceptions in Console panel (download/upload/etc)
 # Not good since errors shown in FTP Log panel anyway
 SHOW_EX = False
@@ -91,7 +129,7 @@ def server_password(server, can_input=True):
         if s:
             return s
 
-        s = dlg_password('CudaText', _('Password for {}:').format(title))
+        s = engine.call_ui(dlg_password, 'CudaText', _('Password for {}:').format(title))
         if not s:
             raise Exception('Password input cancelled')
         pass_inputs[title] = s
@@ -110,6 +148,14 @@ def server_timeout(server):
         return "30"
 
 
+def server_max_connections(server):
+    """ None means global option "pool_max_connections" """
+    s = str(server.get("max_connections", ""))
+    if s.isdigit() and int(s) > 0:
+        return int(s)
+    return None
+
+
 def server_port(server):
     s = server.get("port", "")
     if s.isdigit():
@@ -144,6 +190,44 @@ def server_use_list(server):
     return server.get("use_list", False)
 
 
+def server_sftp_block_size(server):
+    return int(server.get("sftp_block_size", 262144))
+
+
+def server_sftp_max_requests(server):
+    return int(server.get("sftp_max_requests", 64))
+
+
+def server_sftp_window_size(server):
+    return int(server.get("sftp_window_size", 16*1024*1024))
+
+
+def server_segments(server):
+    return int(server.get("segments", 1))
+
+
+def server_segment_threshold(server):
+    return int(server.get("segment_threshold", 64*1024*1024))
+
+
+def server_sftp_delta_upload(server):
+    return bool(server.get("sftp_delta_upload", False))
+
+
+def server_shell(server):
+    """ SFTP server allows to run shell commands (SSH exec) """
+    return bool(server.get("shell", False))
+
+
+def server_tar_stream(server):
+    """ Dirs are downloaded/uploaded as tar stream, by "tar" on server """
+    return bool(server.get("tar_stream", False))
+
+
+def server_tar_gzip(server):
+    return bool(server.get("tar_gzip", False))
+
+
 def server_alias(server):
     return server.get('alias')
 
@@ -178,9 +262,10 @@ def dialog_server(init_server=None):
     _uselist = server_use_list(init_server) if init_server else False
     _pkey = server_pkey_path(init_server) if init_server else ""
     _remote_cert_fp = server_remote_cert_fp(init_server) if init_server else ""
+    _maxconn = str(server_max_connections(init_server) or 0) if init_server else "0"
 
     res = dialog_server_props(_typ, _host, _port, _username, _pass, _dir, _time, _label, _uselist,
-                _pkey)
+                _pkey, _maxconn)
     if res is None:
         return
 
@@ -195,6 +280,7 @@ def dialog_server(init_server=None):
         "label",
         "use_list",
         "pkey_path",
+        "max_connections",
         ), res))
     data["remote_cert_fingerprint"] = _remote_cert_fp
     return data
@@ -232,7 +318,9 @@ class SFTP:
         self.address = address
         self.port = port
         self.sock = socket.create_connection((address, port), timeout=timeout)
-        self.transport = paramiko.transport.Transport(self.sock)
+        # big SSH window lets many requests be in flight on high-latency links
+        self.transport = paramiko.transport.Transport(self.sock,
+            default_window_size=self.window_size)
 
     def login(self, username, password, pkey_path, remote_cert_fp):
         if pkey_path: # login with private key
@@ -262,28 +350,145 @@ class SFTP:
         self.sftp.close()
         self.transport.close()
 
+    def close(self):
+        self.transport.close()
+
+    def noop(self):
+        self.sftp.normalize(".")
+
     # The MLSD command is a replacement for the LIST command that is meant to
     #   standardize the format for directory listings
     def mlsd(self, path, use_list=False):
         for info in self.sftp.listdir_iter(str(path)):
+            modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(info.st_mtime))
             if stat.S_ISDIR(info.st_mode):
-                yield info.filename, dict(type="dir", size=info.st_size)
+                yield info.filename, dict(type="dir", size=info.st_size, modify=modify)
             elif stat.S_ISREG(info.st_mode):
-                yield info.filename, dict(type="file", size=info.st_size)
-
-    def retrbinary(self, command, callback):
+                yield info.filename, dict(type="file", size=info.st_size, modify=modify)
+
+    block_size = 262144
+    max_requests = 64
+    window_size = 16*1024*1024
+    limits = None
+
+    def request_size(self, write=False):
+        """
+        Size of read/write requests: `block_size`, but not more than server allows
+        (by "limits@openssh.com" extension). Without the extension, it's 32 Kb of
+        paramiko, which all servers must accept.
+        """
+        if self.limits is None:
+            self.limits = (32768, 32768)
+            try:
+                t, msg = self.sftp._request(paramiko.sftp.CMD_EXTENDED, "limits@openssh.com")
+                if t == paramiko.sftp.CMD_EXTENDED_REPLY:
+                    msg.get_int64()  # max packet length
+                    max_read, max_write = msg.get_int64(), msg.get_int64()
+                    # 0 is "unknown"
+                    self.limits = (max_read or 32768, max_write or 32768)
+            except (IOError, paramiko.SSHException):
+                pass
+        return min(self.block_size, self.limits[write])
+
+    def retrbinary(self, command, callback, blocksize=None, rest=None, size=None, pipelined=True):
+        """
+        With `pipelined`, many read requests are sent to server at once (paramiko
+        prefetch), so speed is not limited by round trip time.
+        """
         path = command.lstrip("RETR ")
+        blocksize = blocksize or self.block_size
         with self.sftp.open(path, mode="r") as fin:
+            if rest:
+                fin.seek(rest)
+            if pipelined:
+                # paramiko splits reads by it
+                fin.MAX_REQUEST_SIZE = self.request_size()
+                if size is None:
+                    size = fin.stat().st_size
+                try:
+                    fin.prefetch(size, self.max_requests)
+                except TypeError: # old paramiko, without max_concurrent_requests
+                    fin.prefetch(size)
+            else:
+                # one request at a time
+                blocksize = min(blocksize, 32768)
             while True:
-                data = fin.read(8192)
+                data = fin.read(blocksize)
                 if not data:
                     break
 
                 callback(data)
 
-    def storbinary(self, command, fin):
+    def storbinary(self, command, fin, blocksize=None, callback=None, rest=None,
+            length=None, pipelined=True):
+        """
+        With `pipelined`, writes don't wait for server answers (they are checked on close).
+        `length` limits count of bytes sent, for segmented upload.
+        """
         path = command.lstrip("STOR ")
-        self.sftp.putfo(fin, path)
+        blocksize = blocksize or self.block_size
+        with self.sftp.open(path, mode="r+" if rest is not None else "w") as fout:
+            if rest:
+                fout.seek(rest)
+            fout.set_pipelined(pipelined)
+            if pipelined:
+                # paramiko splits writes by it
+                fout.MAX_REQUEST_SIZE = self.request_size(write=True)
+            while length is None or length > 0:
+                data = fin.read(blocksize if length is None else min(blocksize, length))
+                if not data:
+                    break
+                if length is not None:
+                    length -= len(data)
+                fout.write(data)
+                if callback:
+                    callback(data)
+
+    def write_ranges(self, path, fin, ranges, size, callback=None):
+        """
+        Write only given (offset, length) ranges of local file, then cut remote file
+        to `size`
+        """
+        with self.sftp.open(path, mode="r+") as fout:
+            fout.set_pipelined(True)
+            fout.MAX_REQUEST_SIZE = self.request_size(write=True)
+            for offset, length in ranges:
+                fin.seek(offset)
+                fout.seek(offset)
+                while length > 0:
+                    data = fin.read(min(self.block_size, length))
+                    if not data:
+                        break
+                    length -= len(data)
+                    fout.write(data)
+                    if callback:
+                        callback(data)
+            fout.truncate(size)
+
+    def allocate(self, path, size):
+        """ Create file of given size, to write its parts later """
+        with self.sftp.open(path, mode="w") as f:
+            f.truncate(size)
+
+    copy_data = True
+
+    def copy_file(self, src, dst):
+        """
+        Copy file on server by "copy-data" extension of SFTP. Returns False, if server
+        (or paramiko) doesn't support it.
+        """
+        int64 = getattr(paramiko.sftp_client, "int64", None)
+        if not self.copy_data or int64 is None:
+            return False
+        with self.sftp.open(src, mode="r") as fin, self.sftp.open(dst, mode="w") as fout:
+            try:
+                self.sftp._request(paramiko.sftp.CMD_EXTENDED, "copy-data",
+                    fin.handle, int64(0), int64(0), fout.handle, int64(0))
+            except IOError:
+                self.copy_data = False
+        if not self.copy_data:
+            self.sftp.remove(dst)
+        return self.copy_data
 
     def mkd(self, path):
         try:
@@ -294,9 +499,73 @@ class SFTP:
     def rmd(self, path):
         self.sftp.rmdir(path)
 
+    def size(self, path):
+        # None for missing file, as for FTP
+        try:
+            return self.sftp.stat(path).st_size
+        except FileNotFoundError:
+            return None
+
+    def stat(self, path):
+        st = self.sftp.stat(path)
+        return dict(size=st.st_size, modify=time.strftime("%Y%m%d%H%M%S", time.gmtime(st.st_mtime)))
+
     def delete(self, path):
         self.sftp.remove(path)
 
+    def exec_lines(self, command):
+        """
+        Run shell command on server by SSH exec channel, and yield lines of its output
+        while they are received. Exit status is in `exit_status` then.
+        """
+        chan = self.transport.open_session()
+        try:
+            chan.exec_command(command)
+            with chan.makefile("rb") as fout:
+                for line in fout:
+                    yield line.decode("utf-8", errors="replace").rstrip("\r\n")
+            self.exit_status = chan.recv_exit_status()
+        finally:
+            chan.close()
+
+    def exec_channel(self, command):
+        """ Start shell command on server, returns channel to send/receive data """
+        chan = self.transport.open_session()
+        chan.exec_command(command)
+        return chan
+
+    def exec_command(self, command):
+        """ Run shell command on server, returns (exit status, output, errors) """
+        chan = self.transport.open_session()
+        try:
+            chan.exec_command(command)
+            with chan.makefile("rb") as fout, chan.makefile_stderr("rb") as ferr:
+                out = fout.read().decode("utf-8", errors="replace")
+                err = ferr.read().decode("utf-8", errors="replace")
+            return chan.recv_exit_status(), out, err
+        finally:
+            chan.close()
+
+    def delete_many(self, paths, callback=None):
+        """
+        Remove files, with many requests sent at once (if paramiko internals allow)
+        """
+        request = getattr(self.sftp, "_async_request", None)
+        read_response = getattr(self.sftp, "_read_response", None)
+        for i in range(0, len(paths), self.max_requests):
+            chunk = paths[i:i + self.max_requests]
+            if request is None or read_response is None:
+                for path in chunk:
+                    self.sftp.remove(path)
+                    if callback:
+                        callback(path)
+                continue
+            nums = [request(type(None), paramiko.sftp.CMD_REMOVE, path) for path in chunk]
+            for num, path in zip(nums, chunk):
+                read_response(num)
+                if callback:
+                    callback(path)
+
     def _get_private_key(self, username, pkey_path):
         i = 0
         while i < len(SFTP.PK_TYPES):
@@ -308,7 +577,7 @@ class SFTP:
                     break
                 except paramiko.ssh_exception.PasswordRequiredException:
                     title = "sftp://{}@{}:{}".format(username, self.address, self.port)
-                    res = dlg_password(title, _("Enter private key passphrase:"))
+                    res = engine.call_ui(dlg_password, title, _("Enter private key passphrase:"))
                     if res:
                         i -= 1 # repeat same PKeyType
                         pkeys_pass[pkey_path] = res
@@ -367,6 +636,8 @@ def parse_list_line(b, encoding="utf-8"):
 
 
 class FTP_:
+    dropped = False
+
     def __init__(self):
         self._ftp = FTP()
 
@@ -377,14 +648,168 @@ class FTP_:
         self._ftp.login(username, password)
         yield None
 
+    def noop(self):
+        self._ftp.voidcmd("NOOP")
+
+    def retr_range(self, path, start, length, callback, blocksize=65536):
+        """
+        Download `length` bytes from `start`. If file is not read to the end, server
+        answers are unknown, so connection is dropped.
+        """
+        ftp = self._ftp
+        ftp.voidcmd("TYPE I")
+        with ftp.transfercmd("RETR " + path, rest=start) as conn:
+            while length > 0:
+                data = conn.recv(min(blocksize, length))
+                if not data:
+                    raise EOFError("Server closed connection, {} bytes not received".format(length))
+                length -= len(data)
+                callback(data)
+            at_end = not conn.recv(1)
+        if at_end:
+            ftp.voidresp()
+        else:
+            ftp.close()
+            self.dropped = True
+
+    def size(self, path):
+        # SIZE is not supported by all servers, and some need binary mode for it
+        try:
+            self._ftp.voidcmd("TYPE I")
+            return self._ftp.size(path)
+        except error_perm:
+            return None
+
+    def stat(self, path):
+        """
+        Size and modify time (YYYYMMDDHHMMSS) of file, by MLST or SIZE+MDTM.
+        Values are None, if server doesn't tell them.
+        """
+        try:
+            lines = self._ftp.sendcmd("MLST " + path).splitlines()
+        except error_perm:
+            lines = []
+        if len(lines) > 1:
+            facts = {}
+            for fact in lines[1].strip().partition(" ")[0].split(";"):
+                key, _x, value = fact.partition("=")
+                facts[key.lower()] = value
+            if "size" in facts or "modify" in facts:
+                size = facts.get("size")
+                return dict(size=int(size) if size else None, modify=facts.get("modify"))
+
+        try:
+            modify = self._ftp.voidcmd("MDTM " + path)[4:].strip()
+        except error_perm:
+            modify = None
+        return dict(size=self.size(path), modify=modify)
+
+    def fxp_to(self, target, src, dst):
+        """
+        Send file to other FTP server directly (FXP): this server connects to data
+        port, opened by target server (PASV there, PORT here).
+        Returns False, if servers don't allow it.
+        """
+        ftp = self._ftp
+        ftp.voidcmd("TYPE I")
+        target._ftp.voidcmd("TYPE I")
+        try:
+            # address of PASV answer is replaced by known one, as ftplib does
+            host, port = target._ftp.makepasv()
+            if ":" in host:
+                return False  # PORT is for IPv4 only
+            ftp.voidcmd("PORT " + ",".join(host.split(".") + [str(port >> 8), str(port & 255)]))
+        except (error_perm, error_temp, error_proto):
+            return False
+        # target answers STOR only after source connects, i.e. after RETR
+        target._ftp.putcmd("STOR " + dst)
+        try:
+            resp = ftp.sendcmd("RETR " + src)
+            if not resp.startswith("1"):
+                raise error_proto(resp)
+            resp = target._ftp.getresp()
+            if not resp.startswith("1"):
+                raise error_proto(resp)
+        except (error_perm, error_temp, error_proto, OSError, EOFError) as ex:
+            # answers can come later, state of connections is unknown
+            for client in (self, target):
+                client._ftp.close()
+                client.dropped = True
+            if isinstance(ex, error_perm):
+                raise  # no such file, no permission etc
+            return False  # data connection is not made
+        try:
+            # control connections are silent, while file is sent
+            self.wait_long(ftp.voidresp)
+        except Exception:
+            # target waits for data, which will not come
+            target._ftp.close()
+            target.dropped = True
+            raise
+        target.wait_long(target._ftp.voidresp)
+        return True
+
+    def wait_long(self, fn, *args):
+        """ Call fn(*args), which waits for answer to long work on server, without timeout """
+        sock = self._ftp.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(None)
+        try:
+            return fn(*args)
+        finally:
+            sock.settimeout(timeout)
+
+    site_copy = True
+
+    def copy_file(self, src, dst):
+        """
+        Copy file on server by SITE CPFR/CPTO (ProFTPD mod_copy). Returns False,
+        if server doesn't support it.
+        """
+        if not self.site_copy:
+            return False
+        try:
+            self._ftp.sendcmd("SITE CPFR " + src)
+        except error_perm:
+            self.site_copy = False
+            return False
+        # server answers, when file is copied
+        self.wait_long(self._ftp.voidcmd, "SITE CPTO " + dst)
+        return True
+
+    def delete_many(self, paths, callback=None):
+        for path in paths:
+            self._ftp.delete(path)
+            if callback:
+                callback(path)
+
+    def iter_lines(self, cmd):
+        """
+        Same as FTP.retrlines, but yields lines while they are received
+        """
+        ftp = self._ftp
+        ftp.sendcmd("TYPE A")
+        with ftp.transfercmd(cmd) as conn, \
+                conn.makefile("r", encoding=ftp.encoding) as fp:
+            while True:
+                line = fp.readline(ftp.maxline + 1)
+                if len(line) > ftp.maxline:
+                    raise error_proto("got more than %d bytes" % ftp.maxline)
+                if not line:
+                    break
+                if line[-2:] == "\r\n":
+                    line = line[:-2]
+                elif line[-1:] == "\n":
+                    line = line[:-1]
+                yield line
+        ftp.voidresp()
+
     def mlsd(self, path, use_list=False):
         if use_list:
             #show_log('Using old LIST command', str(path))
-            paths = []
             self._ftp.encoding = sys.getfilesystemencoding()
-            self._ftp.retrlines("LIST {}".format(path), callback=paths.append)
-            for path in paths:
-                yield parse_list_line(path)
+            for line in self.iter_lines("LIST {}".format(path)):
+                yield parse_list_line(line)
 
         else:
             # Copied code of FTP.mlsd
@@ -393,9 +818,7 @@ class FTP_:
                 cmd = "MLSD %s" % path
             else:
                 cmd = "MLSD"
-            lines = []
-            self.retrlines(cmd, lines.append)
-            for line in lines:
+            for line in self.iter_lines(cmd):
                 facts_found, _x, name = line.rstrip(CRLF).partition(' ')
                 entry = {}
                 for fact in facts_found[:-1].split(";"):
@@ -404,31 +827,142 @@ class FTP_:
                 yield (name, entry)
 
 
-@contextlib.contextmanager
+def modify_timestamp(modify):
+    """ Unix time from "modify" fact (YYYYMMDDHHMMSS[.sss], UTC) """
+    if not modify:
+        return None
+    try:
+        return calendar.timegm(time.strptime(modify[:14], "%Y%m%d%H%M%S"))
+    except ValueError:
+        return None
+
+
+def is_same_file(path, facts):
+    """ Local file has the same size and modify time as listed remote file """
+    mtime = modify_timestamp(facts.get("modify"))
+    size = facts.get("size")
+    if mtime is None or size is None:
+        return False
+    try:
+        st = path.stat()
+    except OSError:
+        return False
+    return st.st_size == int(size) and int(st.st_mtime) == mtime
+
+
+def tar_member_path(root, name):
+    """ Local path for member of tar, or None if it points out of root dir """
+    name = name.replace("\\", "/")
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if name.startswith("/") or ".." in parts or any(":" in part for part in parts):
+        return None
+    return root.joinpath(*parts)
+
+
+class ChannelWriter:
+    """ File-like object, which sends data written by tarfile to SSH channel """
+
+    def __init__(self, chan, callback):
+        self.chan = chan
+        self.callback = callback
+
+    def write(self, data):
+        check_cancelled()
+        self.chan.sendall(data)
+        self.callback(len(data))
+        return len(data)
+
+
+class ChannelReader:
+    """ File-like object, which gives data received from SSH channel to tarfile """
+
+    def __init__(self, fin, callback):
+        self.fin = fin
+        self.callback = callback
+
+    def read(self, size=-1):
+        check_cancelled()
+        data = self.fin.read(size)
+        self.callback(len(data))
+        return data
+
+
+class QueueReader:
+    """
+    File-like object for storbinary, which reads blocks put to queue by other thread;
+    None is end of file, exception is error of reading.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.data = bytearray()
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.data) < size):
+            check_cancelled()
+            try:
+                block = self.blocks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if block is None:
+                self.eof = True
+            elif isinstance(block, BaseException):
+                raise block
+            else:
+                self.data += block
+        if size < 0:
+            size = len(self.data)
+        data = bytes(self.data[:size])
+        del self.data[:size]
+        return data
+
+
+def is_transient_error(ex):
+    """
+    Errors of network, which can go away if the same thing is repeated
+    """
+    if isinstance(ex, (FileNotFoundError, FileExistsError, PermissionError)):
+        return False
+    if isinstance(ex, (error_temp, EOFError, OSError)): # socket errors are OSError
+        return True
+    if is_too_many_connections(ex):
+        return True
+    if paramiko and isinstance(ex, paramiko.SSHException):
+        return True
+    return False
+
+
 def CommonClient(server):
-    address = server_address(server)
     schema = server_type(server)
     host = server_address(server)
     port = server_port(server)
     timeout = server_timeout(server)
     if schema == "sftp":
         if paramiko is None:
-            msg_box(
+            engine.call_ui(
+                msg_box,
                 _("Please install 'Paramiko' library for SFTP support"),
                 MB_OK | MB_ICONERROR,
             )
         client = SFTP()
+        client.block_size = server_sftp_block_size(server)
+        client.max_requests = server_sftp_max_requests(server)
+        client.window_size = server_sftp_window_size(server)
     elif schema == "ftp":
         client = FTP_()
     else:
         raise Exception("Unknown server type: '{}'".format(schema))
 
     client.connect(host, int(port), timeout=int(timeout))
-    yield client
-    client.quit()
+    return client
 
 
 def show_log(str1, str2):
+    if not is_main_thread():
+        engine.post(show_log, str1, str2)
+        return
+
     time_fmt = "[%H:%M:%S] "
     time_str = datetime.now().strftime(time_fmt)
     text = time_str + str1 + ": " + str2
@@ -454,6 +988,30 @@ icon_names = {
 
 
 NodeInfo = collections.namedtuple("NodeInfo", "caption index image level")
+NodeLocation = collections.namedtuple("NodeLocation", "server_node path kind")
+
+# how often idle pooled connections are checked (msec)
+POOL_TIMER_INTERVAL = 5000
+# how often transfer progress is shown in statusbar (sec)
+STATUS_INTERVAL = 0.3
+# how often "FTP Transfers" panel is updated (msec)
+TRANSFERS_INTERVAL = 1000
+# suffix of not finished downloads
+PART_SUFFIX = ".part"
+# smaller uploads are not remembered to be resumed (they are just sent again)
+RESUME_MIN_SIZE = 1024 * 1024
+# count of NOOP commands to measure round trip time
+SPEED_PINGS = 5
+# tools, which are used on SFTP servers with "shell" option
+SHELL_TOOLS = ("rm", "du", "find", "sha256sum", "tar", "cp")
+# max count of blocks in memory, when file is copied from one connection to another
+PIPE_BLOCKS = 16
+# test file for "Measure upload speed"
+SPEED_TEST_NAME = "cuda_ftp_speed_test.tmp"
+SPEED_TEST_SIZE = 16*1024*1024
+# dir listing is added to tree by parts of N items, or each N seconds
+LISTING_BATCH_SIZE = 500
+LISTING_BATCH_INTERVAL = 0.2
 
 
 class Command:
@@ -483,6 +1041,7 @@ class Command:
             (_("New file..."),      "new_file"),
             (_("New dir..."),       "new_dir"),
             (_("Upload here..."),   "upload_here"),
+            (_("Upload dir here..."), "upload_dir"),
             ("-",                   ""),
             (_("Refresh"),          "refresh"),
         ),
@@ -492,11 +1051,20 @@ class Command:
             ("-",                   ""),
             (_("Remove"),           "remove_dir"),
             (_("Rename"),           "rename_file_dir"),
+            (_("Duplicate..."),     "duplicate"),
+            (_("Copy to server..."), "copy_to_server"),
             (_("Upload here..."),   "upload_here"),
+            (_("Upload dir here..."), "upload_dir"),
+            (_("Download dir..."),  "download_dir"),
+            ("-",                   ""),
+            (_("Find files..."),    "find_files"),
+            (_("Get dir size"),     "dir_size"),
             ("-",                   ""),
             (_("Copy path"),        "copy_path"),
             (_("Copy link"),        "copy_link"),
             ("-",                   ""),
+            (_("Measure upload speed"), "measure_upload_speed"),
+            ("-",                   ""),
             (_("Refresh"),          "refresh"),
         ),
         NODE_FILE: (
@@ -506,11 +1074,15 @@ class Command:
             (_("Rename..."),        "rename_file_dir"),
             (_("Download"),         "download_file"),
             (_("Backup..."),        "backup_file"),
+            (_("Duplicate..."),     "duplicate"),
+            (_("Copy to server..."), "copy_to_server"),
             ("-",                   ""),
             (_("Copy path"),        "copy_path"),
             (_("Copy link"),        "copy_link"),
             ("-",                   ""),
             (_("Get properties"),   "get_properties"),
+            (_("Get checksum"),     "checksum"),
+            (_("Measure download speed"), "measure_speed"),
         ),
     }
 
@@ -538,15 +1110,64 @@ class Command:
                     server['alias'] = next(al for al in server_alias_candidates(server)  if al not in aliases)
                     aliases.append(alias)
 
+        # side index of tree nodes, to not walk the tree on each action
+        self.nodes = {}  # node -> NodeLocation
+        self.node_children = {}  # node -> [child node, ...]
+        self.server_nodes = {}  # server node -> server
+        self.node_refreshes = {}
+
         # fill tree
         for server in self.options["servers"]:
             self.action_new_server(server)
 
-        self.temp_dir = tempfile.TemporaryDirectory()
-        self.temp_dir_path = Path(self.temp_dir.name)
+        if self.options.get("persistent_cache", False):
+            # downloaded files are kept between sessions
+            self.temp_dir = None
+            self.temp_dir_path = settings_dir / "cuda_ftp_cache"
+            try:
+                self.temp_dir_path.mkdir()
+            except FileExistsError:
+                pass
+            cache_index = self.temp_dir_path / "index.json"
+        else:
+            self.temp_dir = tempfile.TemporaryDirectory()
+            self.temp_dir_path = Path(self.temp_dir.name)
+            cache_index = None
+
+        self.pool = ConnectionPool(
+            self.open_client,
+            max_connections=self.options.get("pool_max_connections", 4),
+            idle_timeout=self.options.get("pool_idle_timeout", 120),
+            keepalive=self.options.get("pool_keepalive", 30),
+            server_limit=server_max_connections,
+        )
+        self.pool_task = None
+        timer_proc(TIMER_START, self.pool_on_timer, POOL_TIMER_INTERVAL)
+
+        self.transfers = TransferQueue(workers=self.options.get("transfer_workers", 4))
+        self.transfers_shown = []
+        self.transfers_timer = False
+
+        self.partials = {}  # path of .part file -> remote size
+        self.copies = FileCache(
+            self.temp_dir_path,
+            max_bytes=self.options.get("cache_size_mb", 200) * 1024 * 1024,
+            filename=cache_index,
+            part_suffix=PART_SUFFIX,
+        )
+        self.uploads_lock = threading.Lock()
+        self.saves = {}  # path of saved file -> its running upload task
+        self.shells = {}  # alias -> tools, which can be run on server
+        self.no_fxp = set()  # (alias, alias) of FTP servers, which don't allow FXP
+        self.load_upload_state()
+        self.listings = ListingCache(
+            ttl=self.options.get("listing_cache_ttl", 30),
+            max_entries=self.options.get("listing_cache_size", 200),
+        )
 
     def init_panel(self):
         init_log()
+        init_transfers()
         ed.cmd(cudatext_cmd.cmd_ShowSidePanelAsIs)
 
         self.h_dlg = dlg_proc(0, DLG_CREATE)
@@ -659,13 +1280,44 @@ class Command:
             prop['level']
             )
 
+    def node_kind(self, index):
+        loc = self.nodes.get(index)
+        if loc is not None:
+            return loc.kind
+        return self.get_info(index).image
+
+    def node_add(self, parent, pos, name, kind):
+        index = tree_proc(self.tree, TREE_ITEM_ADD, parent, pos, name, kind)
+        if kind == NODE_SERVER:
+            self.nodes[index] = NodeLocation(index, PurePosixPath("/"), kind)
+        else:
+            loc = self.nodes[parent]
+            self.nodes[index] = NodeLocation(loc.server_node, loc.path / name, kind)
+        self.node_children.setdefault(parent, []).append(index)
+        return index
+
+    def node_forget(self, index):
+        self.nodes.pop(index, None)
+        self.server_nodes.pop(index, None)
+        self.node_refreshes.pop(index, None)
+        for child in self.node_children.pop(index, ()):
+            self.node_forget(child)
+
+    def node_delete(self, index):
+        parent = tree_proc(self.tree, TREE_ITEM_GET_PROPS, index)['parent']
+        tree_proc(self.tree, TREE_ITEM_DELETE, index)
+        self.node_forget(index)
+        children = self.node_children.get(parent)
+        if children and index in children:
+            children.remove(index)
+
     def generate_context_menu(self):
         if not self.h_menu:
             self.h_menu = menu_proc(0, MENU_CREATE)
         menu_proc(self.h_menu, MENU_CLEAR)
 
         if self.selected is not None:
-            i = self.get_info(self.selected).image
+            i = self.node_kind(self.selected)
         else:
             i = None
 
@@ -673,24 +1325,427 @@ class Command:
         for name, action_name in self.actions[i]:
             menu_proc(self.h_menu, MENU_ADD, command="cuda_ftp.action_" + action_name, caption=name)
 
-    def store_file(self, server, server_path, client_path):
+    def run(self, title, fn, *args, on_done=None, on_error=None):
+        """
+        Run fn(*args) in background thread. on_done(result) is called in UI thread,
+        errors are shown in log with given title.
+        """
+        def error(ex):
+            show_log(title, str(ex))
+            if on_error:
+                on_error(ex)
+            if SHOW_EX:
+                raise ex
+
+        return engine.submit(fn, *args, on_done=on_done, on_error=error)
+
+    def transfer(self, title, server, server_path, fn, *args, on_done=None, on_error=None, bulk=False):
+        """
+        Same as run(), but fn(*args) is added to transfer queue, and is shown in
+        "FTP Transfers" panel. Bulk transfers give way to interactive ones (opening
+        of file, upload on save, reading of dir).
+        """
+        def error(ex):
+            show_log(title, str(ex))
+            if on_error:
+                on_error(ex)
+            if SHOW_EX:
+                raise ex
+
+        task = self.transfers.add("{}: {}{}".format(title, server_address(server), server_path),
+            fn, *args, on_done=on_done, on_error=error, bulk=bulk, key=server_alias(server))
+        self.show_transfers()
+        return task
+
+    def show_transfers(self):
+        if not self.transfers_timer:
+            self.transfers_timer = True
+            timer_proc(TIMER_START, self.transfers_on_timer, TRANSFERS_INTERVAL)
+
+    def transfers_on_timer(self, tag='', info=''):
+        self.transfers_shown = list(self.transfers.items)
+        sel = listbox_proc(handle_transfers, LISTBOX_GET_SEL)
+        listbox_proc(handle_transfers, LISTBOX_DELETE_ALL)
+        for text in self.transfers.describe():
+            listbox_proc(handle_transfers, LISTBOX_ADD, index=-1, text=text)
+        if sel is not None and 0 <= sel < len(self.transfers_shown):
+            listbox_proc(handle_transfers, LISTBOX_SET_SEL, index=sel)
+        if not self.transfers.active():
+            self.transfers_timer = False
+            timer_proc(TIMER_STOP, self.transfers_on_timer, 0)
+
+    def transfers_on_menu(self, id_dlg, id_ctl, data='', info=''):
+        sel = listbox_proc(handle_transfers, LISTBOX_GET_SEL)
+        transfer = None
+        if sel is not None and 0 <= sel < len(self.transfers_shown):
+            transfer = self.transfers_shown[sel]
+        items = [_("Cancel"), _("Retry"), _("Clear finished")]
+        res = dlg_menu(DMENU_LIST, items, caption=TITLE_TRANSFERS)
+        if res == 0 and transfer is not None:
+            transfer.cancel()
+        elif res == 1 and transfer is not None and transfer.state in (FAILED, CANCELLED):
+            self.transfers.retry(transfer)
+            self.show_transfers()
+        elif res == 2:
+            self.transfers.clear_finished()
+        self.transfers_on_timer()
+
+    def stop_operations(self):
+        cnt = engine.cancel_all()
+        msg_status(_('Stopping FTP operations: {}').format(cnt))
+
+    def upload_file(self, server, server_path, client_path, quiet=False):
         try:
-            with CommonClient(server) as client:
-                self.login(client, server)
+            uploaded = self.upload_delta(server, server_path, client_path)
+        except Exception as ex:
+            if not is_transient_error(ex):
+                raise
+            show_log("Upload file", "{}; sending whole file".format(ex))
+            uploaded = False
+        if not uploaded:
+            self.retrying("Upload file", self.upload_part, server, server_path, client_path)
+        self.listings.set_entry(server_alias(server), server_path.parent, server_path.name,
+            dict(type="file", size=str(client_path.stat().st_size)))
+        self.listings.add_dir(server_alias(server), server_path.parent)
+        self.remember_copy(server, server_path, client_path)
+        if not quiet:
+            show_log("[↑] Uploaded", server_address(server) + str(server_path))
 
-                try:
-                    client.mkd(str(server_path.parent))
-                except error_perm:
-                    pass
-                with client_path.open(mode="rb") as fin:
-                    client.storbinary("STOR " + str(server_path), fin)
+    def remember_copy(self, server, server_path, client_path, remote=None):
+        """
+        Remember remote size/modify time of the file, which equals to local one
+        """
+        try:
+            client_path.relative_to(self.temp_dir_path)
+        except ValueError:
+            # not opened from server
+            return
+        if remote is None:
+            try:
+                with self.pool.client(server) as client:
+                    remote = client.stat(str(server_path))
+            except error_perm:
+                remote = None
+        if remote is None or remote["modify"] is None:
+            self.copies.remove(client_path)
+            return
+        self.copies.put(client_path, remote)
+        if self.copies.filename is not None:
+            # files opened in editor are not removed
+            keep = engine.call_ui(self.editor_filenames) + [str(client_path)]
+            for path in self.copies.evict(keep):
+                show_log("[!] Removed from cache", str(path))
+
+    def editor_filenames(self):
+        return [Editor(h).get_filename() for h in ed_handles()]
+
+    def upload_delta(self, server, server_path, client_path):
+        """
+        For SFTP, write only changed blocks of file, if server file is the same as
+        the last downloaded/uploaded one. Returns False, if whole file must be sent.
+        """
+        if server_type(server) != "sftp" or not server_sftp_delta_upload(server):
+            return False
+        entry = self.copies.get(client_path)
+        if entry is None or "blocks" not in entry:
+            return False
 
-            show_log("[↑] Uploaded", server_address(server) + str(server_path))
+        with self.pool.client(server) as client:
+            try:
+                remote = client.stat(str(server_path))
+            except FileNotFoundError:
+                return False
+            if remote["size"] != entry["size"] or remote["modify"] != entry["modify"]:
+                show_log("[↑] File is changed on server", server_address(server) + str(server_path))
+                return False
+
+            size = client_path.stat().st_size
+            ranges = changed_ranges(entry["blocks"], file_hashes(client_path)[1], size)
+            with client_path.open(mode="rb") as fin:
+                client.write_ranges(str(server_path), fin, ranges, size)
+
+        show_log("[↑] Delta upload", "{}{}: {} of {} bytes".format(server_address(server),
+            server_path, sum(length for _x, length in ranges), size))
+        return True
+
+    def upload_part(self, server, server_path, client_path):
+        """
+        Upload is remembered in "cuda_ftp_uploads.json" until it's finished (if file
+        is not small). If it's broken, next upload of the same (not changed) file
+        sends only the missing tail.
+        """
+        task = current_task()
+
+        def stor_callback(data):
+            nonlocal progress
+            nonlocal progress_time
+            progress += len(data)
+
+            if task is not None and task.cancelled:
+                text = "Uploading of '{}' stopped".format(server_path.name)
+                engine.post(msg_status, text)
+                raise Cancelled(text)
+            if task is not None:
+                task.report(progress, st.st_size)
+
+            now = time.monotonic()
+            if now - progress_time > STATUS_INTERVAL:
+                progress_time = now
+                engine.post(
+                    msg_status,
+                    _("Uploading '{}': {} Kbytes").format(server_path.name, progress // 1024)
+                )
+
+        key = "{}:{}".format(server_alias(server), server_path)
+        st = client_path.stat()
+        state = dict(local=str(client_path), size=st.st_size, mtime=st.st_mtime)
+        progress_time = time.monotonic()
+
+        with self.pool.client(server) as client:
+
+            # dir can be removed on server after it was listed
+            parent_known = self.listings.has_dir(server_alias(server), server_path.parent)
+            self.ensure_dir(client, server, server_path.parent)
+
+            offset = 0
+            segmented = isinstance(client, SFTP) and server_segments(server) > 1 and \
+                st.st_size >= server_segment_threshold(server)
+            with self.uploads_lock:
+                resume = self.uploads.get(key) == state
+            if resume:
+                remote_size = client.size(str(server_path))
+                if remote_size and remote_size < st.st_size:
+                    offset = remote_size
+            elif st.st_size >= RESUME_MIN_SIZE:
+                self.save_upload_state(key, state)
+            progress = offset
+
+            with client_path.open(mode="rb") as fin:
+
+                def store():
+                    fin.seek(0)
+                    client.storbinary("STOR " + str(server_path), fin,
+                        callback=stor_callback)
+
+                if offset:
+                    show_log("[↑] Resume", "{}{} from {} bytes".format(
+                        server_address(server), server_path, offset))
+                    fin.seek(offset)
+                    try:
+                        client.storbinary("STOR " + str(server_path), fin,
+                            callback=stor_callback, rest=offset)
+                    except error_perm:
+                        # REST+STOR is not supported, append to the end instead
+                        fin.seek(offset)
+                        try:
+                            client.storbinary("APPE " + str(server_path), fin,
+                                callback=stor_callback)
+                        except error_perm:
+                            # no way to resume, send the whole file
+                            progress = 0
+                            store()
+                elif segmented:
+                    self.write_in_dir(client, server, server_path, parent_known,
+                        client.allocate, str(server_path), st.st_size)
+                else:
+                    self.write_in_dir(client, server, server_path, parent_known, store)
+
+        if segmented and not offset:
+            self.upload_segments(server, server_path, client_path, st.st_size, stor_callback)
+        self.save_upload_state(key, None)
+
+    def write_in_dir(self, client, server, path, parent_known, fn, *args):
+        """
+        Call fn(*args), which writes file `path`. If its dir was not created now,
+        but only known from earlier listing, and server says it's missing, the dir
+        is created again and fn is called once more.
+        """
+        try:
+            return fn(*args)
+        except (error_perm, FileNotFoundError) as ex:
+            if not parent_known or isinstance(ex, error_perm) and not str(ex).startswith("550"):
+                raise
+        self.listings.forget_dir(server_alias(server), path.parent)
+        self.ensure_dir(client, server, path.parent)
+        return fn(*args)
+
+    def ensure_dir(self, client, server, path):
+        """
+        Create dir with missing parents, if it's not known to exist
+        """
+        alias = server_alias(server)
+        missing = []
+        while not self.listings.has_dir(alias, path):
+            missing.append(path)
+            path = path.parent
+        for path in reversed(missing):
+            try:
+                client.mkd(str(path))
+            except error_perm:
+                pass
+
+    def batch_workers(self, server):
+        # bulk work leaves one connection for interactive work
+        return max(1, self.pool.limit(server) - 1)
+
+    def batch_job(self, batch, title, fn, *args):
+        """
+        Run fn(*args) as one item of batch. Errors are shown in log, and other items
+        go on; returns False on error.
+        """
+        item = batch.item()
+        try:
+            if item.cancelled:
+                raise Cancelled("Stopped by user")
+            in_task(item, fn, *args)
+        except Cancelled:
+            raise
         except Exception as ex:
-            show_log("Upload file", str(ex))
-            if SHOW_EX:
+            show_log(title, str(ex))
+            return False
+        finally:
+            batch.finish(item)
+        return True
+
+    def split_segments(self, server, size):
+        count = min(server_segments(server), self.pool.limit(server))
+        seg_size = -(-size // count)
+        return [(start, min(seg_size, size - start)) for start in range(0, size, seg_size)]
+
+    def run_segments(self, server, segments, fn):
+        """
+        Call fn(client, start, length) for each segment in parallel, each with its own
+        pooled connection.
+        """
+        sub = SubTask(current_task())
+
+        def run_one(start, length):
+            with self.pool.client(server) as client:
+                return fn(client, start, length)
+
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(in_task, sub, run_one, start, length)
+                        for start, length in segments]
+            try:
+                return [f.result() for f in futures]
+            except BaseException:
+                # stop other segments
+                sub.cancel()
                 raise
 
+    def upload_segments(self, server, server_path, client_path, size, callback):
+        segments = self.split_segments(server, size)
+        show_log("[↑] Segmented upload", "{}{}: {} segments".format(
+            server_address(server), server_path, len(segments)))
+        lock = threading.Lock()
+
+        def locked_callback(data):
+            check_cancelled()
+            with lock:
+                callback(data)
+
+        def upload_segment(client, start, length):
+            with client_path.open(mode="rb") as fin:
+                fin.seek(start)
+                client.storbinary("STOR " + str(server_path), fin,
+                    callback=locked_callback, rest=start, length=length)
+
+        self.run_segments(server, segments, upload_segment)
+
+    def load_upload_state(self):
+        self.uploads_filename = Path(app_path(APP_DIR_SETTINGS)) / "cuda_ftp_uploads.json"
+        self.uploads = {}
+        if self.uploads_filename.exists():
+            try:
+                with self.uploads_filename.open(encoding="utf-8") as fin:
+                    self.uploads = json.load(fin)
+            except ValueError:
+                pass
+
+    def save_upload_state(self, key, state):
+        with self.uploads_lock:
+            if state is None:
+                if self.uploads.pop(key, None) is None:
+                    return
+            else:
+                self.uploads[key] = state
+            with self.uploads_filename.open(mode="w", encoding="utf-8") as fout:
+                json.dump(self.uploads, fout, indent=2)
+
+    def store_file(self, server, server_path, client_path, on_done=None):
+        self.transfer("Upload file", server, server_path,
+            self.upload_file, server, server_path, client_path,
+            on_done=on_done and (lambda result: on_done()))
+
+    def save_file(self, server, server_path, client_path):
+        """
+        Upload after "Save". Only one upload of a file runs at a time: if file is saved
+        again meanwhile, running upload is stopped, and the latest content is uploaded
+        after it, so quick saves give one upload.
+        """
+        key = str(client_path)
+        task = self.saves.get(key)
+        if task is not None:
+            if not task.superseded:
+                task.superseded = True
+                task.cancel()
+                show_log("[↑] Upload superseded", server_address(server) + str(server_path))
+            return task
+
+        def finished(result):
+            if self.saves.get(key) is not task:
+                return
+            del self.saves[key]
+            if task.superseded:
+                self.save_file(server, server_path, client_path)
+
+        def error(ex):
+            if not task.superseded:
+                show_log("Upload file", str(ex))
+            finished(None)
+
+        task = self.transfers.add("Upload file: " + server_address(server) + str(server_path),
+            self.upload_file, server, server_path, client_path, on_done=finished, on_error=error,
+            key=server_alias(server))
+        self.show_transfers()
+        task.superseded = False
+        # retried upload must be known as running one too
+        task.on_retry = lambda: self.save_file(server, server_path, client_path)
+        self.saves[key] = task
+        return task
+
+    def open_client(self, server):
+        client = CommonClient(server)
+        try:
+            self.login(client, server)
+        except Exception:
+            self.pool.close_client(client)
+            raise
+        return client
+
+    def pool_on_timer(self, tag='', info=''):
+        # NOOP probes wait for server, so don't do them in UI thread
+        if self.pool_task is None or self.pool_task.future.done():
+            self.pool_task = engine.submit(self.pool.expire)
+
+    def close_connections(self, alias):
+        """
+        Close idle connections to server, after its options are changed. QUIT waits
+        for server, so it's sent in background.
+        """
+        clients = self.pool.take_all(alias)
+        if clients:
+            engine.submit(self.pool.close_clients, clients)
+
+    def on_exit(self, ed_self):
+        if self.inited:
+            timer_proc(TIMER_STOP, self.pool_on_timer, 0)
+            timer_proc(TIMER_STOP, self.transfers_on_timer, 0)
+            self.transfers.shutdown()
+            engine.shutdown()
+            # don't wait for answers to QUIT on exit
+            self.pool.close_all(quit=False)
+
     def login(self, client, server):
         resgen = client.login(server_login(server), server_password(server),
                     server_pkey_path(server), server_remote_cert_fp(server))
@@ -713,10 +1768,10 @@ class Command:
         fingerprints = "[MD5]: {}\n[SHA1]: {}".format(get_fingerprint("md5", r_remote_cert), sha1_fp)
         if item == SFTP.CONFIRM_FIRST_CONNECTION_CERT:
             msg = _("First connection to this host.\nAccept host's certificate?\n\n")+fingerprints
-            res = msg_box(msg, MB_OKCANCEL | MB_ICONQUESTION)
+            res = engine.call_ui(msg_box, msg, MB_OKCANCEL | MB_ICONQUESTION)
             if res == ID_OK:
                 server["remote_cert_fingerprint"] = sha1_fp
-                self.save_options()
+                engine.call_ui(self.save_options)
                 show_log('Private key Auth', 'Accepted host\'s certificate')
                 next(resgen) # continue login process
                 return
@@ -725,53 +1780,169 @@ class Command:
 
         elif item == SFTP.NEW_REMOTE_CERT_WARN:
             msg = _("Host's certificate changed! Proceed?\n\n")+fingerprints
-            res = msg_box(msg, MB_OKCANCEL | MB_ICONWARNING)
+            res = engine.call_ui(msg_box, msg, MB_OKCANCEL | MB_ICONWARNING)
             if res == ID_OK:
                 server["remote_cert_fingerprint"] = sha1_fp
-                self.save_options()
+                engine.call_ui(self.save_options)
                 show_log('Private key Auth', 'Accepted changed host\'s certificate')
                 next(resgen) # continue login process
                 return
             else:
                 raise Exception('Login canceled! Did not accept remote host\'s changed certificate.')
 
-    def retrieve_file(self, server, server_path, client_path):
+    def retrying(self, title, fn, *args):
+        """
+        Call fn(*args), repeat it after network errors, with growing delay
+        """
+        retries = self.options.get("retries", 3)
+        delay = self.options.get("retry_delay", 2)
+        attempt = 0
+        while True:
+            try:
+                return fn(*args)
+            except Exception as ex:
+                attempt += 1
+                if attempt > retries or not is_transient_error(ex):
+                    raise
+                show_log(title, "{}; retry {} of {} in {} sec".format(ex, attempt, retries, delay))
+                sleep_cancellable(delay)
+                delay *= 2
+
+    def retrieve_file(self, server, server_path, client_path, use_cache=False):
+        """
+        Download goes to "name.part" file; if download is broken, next attempt
+        continues from the end of that file.
+        With `use_cache`, file is not downloaded if local copy has the same remote
+        size and modify time as server file; then True is returned.
+        """
         try:
             client_path.parent.mkdir(parents=True)
         except FileExistsError:
             pass
 
-        def retr_callback(data):
+        remote = None
+        if use_cache:
+            with self.pool.client(server) as client:
+                try:
+                    remote = client.stat(str(server_path))
+                except error_perm:
+                    pass
+            if remote is not None and self.copies.is_fresh(client_path, remote):
+                show_log("[↓] Cache hit", server_address(server) + str(server_path))
+                return True
+
+        part_path = client_path.with_name(client_path.name + PART_SUFFIX)
+        self.retrying("Download file", self.retrieve_part, server, server_path, part_path)
+        os.replace(str(part_path), str(client_path))
+        if use_cache:
+            self.remember_copy(server, server_path, client_path, remote)
+        return False
+
+    def retrieve_part(self, server, server_path, part_path):
+        task = current_task()
+
+        def progress_callback(data):
             nonlocal progress
-            nonlocal progress_prev
+            nonlocal progress_time
             progress += len(data)
 
-            TEST_ESC_EACH_KBYTES = 50
-            SMOOTH_SIZE_KBYTES = 30
-            if (progress-progress_prev) // 1024 > TEST_ESC_EACH_KBYTES:
-                msg_status(
-                    _("Downloading '{}': {} Kbytes").format(
-                        server_path.name,
-                        # rounding by N kb: divide, then multiply
-                        progress // 1024 // SMOOTH_SIZE_KBYTES * SMOOTH_SIZE_KBYTES,
-                    ),
-                    True
+            if task is not None and task.cancelled:
+                text = "Downloading of '{}' stopped".format(server_path.name)
+                engine.post(msg_status, text)
+                raise Cancelled(text)
+            if task is not None:
+                task.report(progress, remote_size)
+
+            now = time.monotonic()
+            if now - progress_time > STATUS_INTERVAL:
+                progress_time = now
+                engine.post(
+                    msg_status,
+                    _("Downloading '{}': {} Kbytes").format(server_path.name, progress // 1024)
                 )
-                progress_prev = progress
-                if app_proc(PROC_GET_ESCAPE, ''):
-                    text = "Downloading of '{}' stopped".format(server_path.name)
-                    msg_status(text)
-                    raise Exception(text)
 
+        def retr_callback(data):
+            progress_callback(data)
             fout.write(data)
 
-        progress = 0
-        progress_prev = 0
-        app_proc(PROC_SET_ESCAPE, '0')
-        with CommonClient(server) as client:
-            self.login(client, server)
-            with client_path.open(mode="wb") as fout:
-                client.retrbinary("RETR " + str(server_path), retr_callback)
+        progress_time = time.monotonic()
+        with self.pool.client(server) as client:
+            remote_size = client.size(str(server_path))
+
+            # resume only if remote file is the same, as it was for the previous attempt
+            offset = 0
+            if part_path.exists() and remote_size is not None and \
+                    self.partials.get(str(part_path)) == remote_size:
+                offset = part_path.stat().st_size
+                if offset > remote_size:
+                    offset = 0
+            progress = offset
+
+            segmented = isinstance(client, FTP_) and not offset and remote_size is not None \
+                and server_segments(server) > 1 and remote_size >= server_segment_threshold(server)
+            if segmented:
+                # preallocated file can't be resumed
+                self.partials.pop(str(part_path), None)
+            else:
+                self.partials[str(part_path)] = remote_size
+
+            with part_path.open(mode="ab" if offset else "wb") as fout:
+                if segmented or offset and offset == remote_size:
+                    pass
+                elif offset:
+                    show_log("[↓] Resume", "{}{} from {} bytes".format(
+                        server_address(server), server_path, offset))
+                    try:
+                        client.retrbinary("RETR " + str(server_path), retr_callback, rest=offset)
+                    except error_perm:
+                        # REST is not supported, download all again
+                        fout.seek(0)
+                        fout.truncate()
+                        progress = 0
+                        client.retrbinary("RETR " + str(server_path), retr_callback)
+                else:
+                    client.retrbinary("RETR " + str(server_path), retr_callback)
+
+        if segmented:
+            try:
+                self.download_segments(server, server_path, part_path, remote_size, progress_callback)
+            except error_perm:
+                # REST is not supported
+                progress = 0
+                with self.pool.client(server) as client:
+                    with part_path.open(mode="wb") as fout:
+                        client.retrbinary("RETR " + str(server_path), retr_callback)
+
+        size = part_path.stat().st_size
+        if remote_size is not None and size != remote_size:
+            raise EOFError("Downloaded {} of {} bytes".format(size, remote_size))
+        self.partials.pop(str(part_path), None)
+
+    def download_segments(self, server, server_path, part_path, size, callback):
+        """
+        Download ranges of file by several connections at once (REST + RETR),
+        into preallocated local file
+        """
+        segments = self.split_segments(server, size)
+        show_log("[↓] Segmented download", "{}{}: {} segments".format(
+            server_address(server), server_path, len(segments)))
+        with part_path.open(mode="wb") as f:
+            f.truncate(size)
+        lock = threading.Lock()
+
+        def download_segment(client, start, length):
+            with part_path.open(mode="r+b") as fout:
+                fout.seek(start)
+
+                def segment_callback(data):
+                    check_cancelled()
+                    fout.write(data)
+                    with lock:
+                        callback(data)
+
+                client.retr_range(str(server_path), start, length, segment_callback)
+
+        self.run_segments(server, segments, download_segment)
 
     def get_server_by_alias(self, alias):
         for server in self.options["servers"]:
@@ -790,14 +1961,19 @@ class Command:
 
 
     def get_location_by_index(self, index):
-        path = []
-        while not self.get_info(index).image == NODE_SERVER: # build path from tree nodes
-            path.append(self.get_info(index).caption)
-            index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, index)['parent']
-        path.reverse()
-        server_path = PurePosixPath("/" + str.join("/", path))
+        loc = self.nodes.get(index)
+        if loc is not None:
+            server = self.server_nodes[loc.server_node]
+            server_path = loc.path
+        else:
+            path = []
+            while not self.get_info(index).image == NODE_SERVER: # build path from tree nodes
+                path.append(self.get_info(index).caption)
+                index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, index)['parent']
+            path.reverse()
+            server_path = PurePosixPath("/" + str.join("/", path))
 
-        server = self.get_server_by_alias(self.get_info(index).caption)
+            server = self.get_server_by_alias(self.get_info(index).caption)
 
         prefix = pathlib.Path(
             server_type(server),
@@ -821,42 +1997,118 @@ class Command:
         return server, server_path, client_path
 
     def node_remove_children(self, node_index):
-        nodes = tree_proc(self.tree, TREE_ITEM_ENUM_EX, node_index)
-        for node in nodes:
-            tree_proc(self.tree, TREE_ITEM_DELETE, node['id'])
-
-    def node_refresh(self, node_index):
-        server, server_path, _x = self.get_location_by_index(node_index)
-        try:
-            with CommonClient(server) as client:
-                self.login(client, server)
-                path_list = sorted(
-                    client.mlsd(server_path, server_use_list(server)),
-                    key=lambda p: (p[1]["type"], p[0])
+        children = self.node_children.pop(node_index, None)
+        if children is None:
+            children = [node['id'] for node in tree_proc(self.tree, TREE_ITEM_ENUM_EX, node_index) or ()]
+        tree_proc(self.tree, TREE_LOCK)
+        for index in children:
+            tree_proc(self.tree, TREE_ITEM_DELETE, index)
+            self.node_forget(index)
+        tree_proc(self.tree, TREE_UNLOCK)
+
+    def list_dir(self, server, server_path, use_cache=True, on_batch=None):
+        """
+        If on_batch is given, it's called (in worker thread) with parts of listing,
+        while listing is received from server.
+        """
+        alias = server_alias(server)
+        if use_cache:
+            path_list = self.listings.get(alias, server_path)
+            if path_list is not None:
+                show_log(
+                    "[cache] Read dir",
+                    "{}{} ({})".format(server_address(server), server_path, self.listings.stats())
                 )
-        except Exception as ex:
-            show_log(
-                "Read dir: " + server_address(server) + str(server_path),
-                str(ex)
-            )
-            raise
-
+                if on_batch:
+                    on_batch(path_list)
+                return path_list
+
+        path_list = []
+        batch = []
+        batch_time = time.monotonic()
+        with self.pool.client(server) as client:
+            for name, facts in client.mlsd(server_path, server_use_list(server)):
+                check_cancelled()
+                path_list.append((str(name), facts))
+                if on_batch is None:
+                    continue
+                batch.append((str(name), facts))
+                if len(batch) >= LISTING_BATCH_SIZE or \
+                        time.monotonic() - batch_time > LISTING_BATCH_INTERVAL:
+                    on_batch(batch)
+                    batch = []
+                    batch_time = time.monotonic()
+        if batch:
+            on_batch(batch)
+        self.listings.put(alias, server_path, path_list)
+        return path_list
+
+    def node_add_items(self, node_index, path_list, dirs, files):
+        """
+        Add nodes for listing items. Dirs are added after dirs, files to the end;
+        names of added nodes are appended to lists `dirs` and `files`.
+        """
+        tree_proc(self.tree, TREE_LOCK)
         for name, facts in path_list:
             if facts["type"] == "dir":
-                NodeType = NODE_DIR
+                self.node_add(node_index, len(dirs), name, NODE_DIR)
+                dirs.append(name)
             elif facts["type"] == "file":
-                NodeType = NODE_FILE
+                self.node_add(node_index, -1, name, NODE_FILE)
+                files.append(name)
+        tree_proc(self.tree, TREE_UNLOCK)
+
+    def node_refresh(self, node_index, use_cache=True, on_done=None, on_error=None):
+        server, server_path, _x = self.get_location_by_index(node_index)
+
+        # items are shown while listing is received, then sorted at the end
+        dirs = []
+        files = []
+        started = False
+
+        def add_batch(batch):
+            nonlocal started
+            if self.node_refreshes.get(node_index) is not task:
+                return
+            if not started:
+                started = True
+                self.node_remove_children(node_index)
+                self.node_add_items(node_index, batch, dirs, files)
+                tree_proc(self.tree, TREE_ITEM_UNFOLD_DEEP, node_index)
             else:
-                continue
-            tree_proc(
-                self.tree,
-                TREE_ITEM_ADD,
-                node_index,
-                -1,
-                str(name),
-                NodeType
-            )
-        tree_proc(self.tree, TREE_ITEM_UNFOLD_DEEP, node_index)
+                self.node_add_items(node_index, batch, dirs, files)
+
+        def fill(path_list):
+            if self.node_refreshes.get(node_index) is not task:
+                return
+            del self.node_refreshes[node_index]
+            if not started or dirs != sorted(dirs) or files != sorted(files):
+                self.node_remove_children(node_index)
+                dirs.clear()
+                files.clear()
+                path_list = sorted(path_list, key=lambda p: (p[1]["type"], p[0]))
+                self.node_add_items(node_index, path_list, dirs, files)
+            tree_proc(self.tree, TREE_ITEM_UNFOLD_DEEP, node_index)
+            if on_done:
+                on_done()
+
+        def error(ex):
+            if self.node_refreshes.get(node_index) is not task:
+                return
+            del self.node_refreshes[node_index]
+            self.node_remove_children(node_index)
+            if on_error:
+                on_error(ex)
+
+        # newer refresh of the same node replaces older one
+        task = self.run(
+            "Read dir: " + server_address(server) + str(server_path),
+            self.list_dir, server, server_path, use_cache,
+            lambda batch: engine.post(add_batch, batch),
+            on_done=fill,
+            on_error=error,
+        )
+        self.node_refreshes[node_index] = task
 
     def list_aliases(self):
         return [server_alias(s) for s in self.options["servers"]]
@@ -869,7 +2121,7 @@ class Command:
             Path(filename).relative_to(self.temp_dir_path)
         except ValueError:
             return
-        self.store_file(*self.get_location_by_filename(filename))
+        self.save_file(*self.get_location_by_filename(filename))
 
     def action_new_server(self, server=None):
         if server is None:
@@ -888,7 +2140,8 @@ class Command:
             self.save_options()
             server = server_info
         caption = server_alias(server)
-        tree_proc(self.tree, TREE_ITEM_ADD, 0, -1, caption, 0)
+        index = self.node_add(0, -1, caption, NODE_SERVER)
+        self.server_nodes[index] = server
 
     def action_edit_server(self):
         server, *_x = self.get_location_by_index(self.selected)
@@ -897,10 +2150,16 @@ class Command:
             return
 
         server_info['alias'] = server_alias(server)
+        # keep options, which are not in the dialog
+        server_info = dict(server, **server_info)
+        self.close_connections(server_alias(server))
+        self.listings.invalidate(server_alias(server))
+        self.shells.pop(server_alias(server), None)
         servers = self.options["servers"]
         i = servers.index(server)
         servers[i] = server_info
         server = server_info
+        self.server_nodes[self.selected] = server
 
         caption = server_alias(server)
         tree_proc(self.tree, TREE_ITEM_SET_TEXT, self.selected, 0, caption)
@@ -927,6 +2186,8 @@ class Command:
             if res == '': # reset to default
                 res = next(al for al in server_alias_candidates(server)  if al not in aliases)
             if res not in aliases:
+                self.close_connections(alias)
+                self.listings.invalidate(alias)
                 server['alias'] = res
                 break
             prev = res
@@ -940,7 +2201,9 @@ class Command:
         res = msg_box(_("Do you really want to remove server?"), MB_YESNO+MB_ICONQUESTION)
         if res == ID_YES:
             server, *_x = self.get_location_by_index(self.selected)
-            tree_proc(self.tree, TREE_ITEM_DELETE, self.selected)
+            self.close_connections(server_alias(server))
+            self.listings.invalidate(server_alias(server))
+            self.node_delete(self.selected)
             servers = self.options["servers"]
             servers.pop(servers.index(server))
             self.save_options()
@@ -974,23 +2237,24 @@ class Command:
         def get_filename_(dat_):
             return (str(dat_).split("/"))[-1]
 
-        self.goto_server_path(get_filedir_(path_))
+        def select_file():
+            prop_list = tree_proc(self.tree, TREE_ITEM_ENUM_EX, self.selected)
+            for prop in prop_list:
+                if prop['text'] == get_filename_(path_):
+                    node = prop['id']
+                    tree_proc(self.tree, TREE_ITEM_SELECT, node)
+                    tree_proc(self.tree, TREE_ITEM_SHOW, node)
+                    break
 
-        prop_list = tree_proc(self.tree, TREE_ITEM_ENUM_EX, self.selected)
-        for prop in prop_list:
-            if prop['text'] == get_filename_(path_):
-                node = prop['id']
-                tree_proc(self.tree, TREE_ITEM_SELECT, node)
-                tree_proc(self.tree, TREE_ITEM_SHOW, node)
-                break
+            info = self.get_info(self.selected)
+            if info.caption == get_filename_(path_):
+                if info.image == NODE_FILE:
+                    self.action_open_file()
+                    self.save_to_history(False, pinned_)
+            else:
+                msg_status(_('Error: file not found on server!'))
 
-        info = self.get_info(self.selected)
-        if info.caption == get_filename_(path_):
-            if info.image == NODE_FILE:
-                self.action_open_file()
-                self.save_to_history(False, pinned_)
-        else:
-            msg_status(_('Error: file not found on server!'))
+        self.goto_server_path(get_filedir_(path_), on_done=select_file)
 
     def get_server_alias_path(self):
         server, *xx = self.get_location_by_index(self.selected)
@@ -1092,56 +2356,44 @@ class Command:
         if err:
             msg_box(_('No history found'), MB_OK)
 
-    def goto_server_path(self, goto):
+    def goto_server_path(self, goto, use_cache=True, on_done=None):
         path = PurePosixPath(goto)
-        self.node_remove_children(self.selected)
-        node = self.selected
+        root = self.selected
+        self.node_remove_children(root)
+        node = root
         for name in filter(lambda n: n != "/", path.parts):
-            node = tree_proc(
-                self.tree,
-                TREE_ITEM_ADD,
-                node,
-                -1,
-                name,
-                NODE_DIR
-            )
-        try:
-            self.node_refresh(node)
-        except:
-            self.node_remove_children(self.selected)
-            if SHOW_EX:
-                raise
-            else:
-                return
-        tree_proc(self.tree, TREE_ITEM_UNFOLD_DEEP, self.selected)
-        tree_proc(self.tree, TREE_ITEM_SELECT, node)
+            node = self.node_add(node, -1, name, NODE_DIR)
 
-        self.save_to_history(goto)
+        def done():
+            tree_proc(self.tree, TREE_ITEM_UNFOLD_DEEP, root)
+            tree_proc(self.tree, TREE_ITEM_SELECT, node)
+            self.save_to_history(goto)
+            if on_done:
+                on_done()
 
-    def refresh_node(self, index):
-        self.node_remove_children(index)
-        try:
-            self.node_refresh(index)
-        except:
-            if SHOW_EX:
-                raise
+        self.node_refresh(node, use_cache,
+            on_done=done,
+            on_error=lambda ex: self.node_remove_children(root))
 
-    def action_refresh(self):
+    def refresh_node(self, index, use_cache=True, on_done=None):
+        self.node_refresh(index, use_cache, on_done)
+
+    def action_refresh(self, use_cache=False, on_done=None):
         # special case: refresh of server, with "init dir" set
         if self.is_selected_server():
             server, server_path, client_path = self.get_location_by_index(
                 self.selected)
             goto = server_init_dir(server)
             if goto:
-                self.goto_server_path(goto)
+                self.goto_server_path(goto, use_cache, on_done)
                 return
-        info = self.get_info(self.selected)
-        if info.image == NODE_FILE:
+        kind = self.node_kind(self.selected)
+        if kind == NODE_FILE:
             index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
-            self.refresh_node(index)
+            self.refresh_node(index, use_cache, on_done)
             self.select_node_parent(index)
         else:
-            self.refresh_node(self.selected)
+            self.refresh_node(self.selected, use_cache, on_done)
 
     def action_new_file(self):
         server, server_path, client_path = self.get_location_by_index(
@@ -1161,11 +2413,13 @@ class Command:
         path = client_path / name
         path.touch()
         file_open(str(path), options='/nozip')
-        server, server_path
-        self.store_file(server, server_path / name, path)
-        self.action_refresh()
-        self.select_node(self.selected, str(path))
-        self.save_to_history(str(server_path / name))
+
+        def refreshed():
+            self.select_node(self.selected, str(path))
+            self.save_to_history(str(server_path / name))
+
+        self.store_file(server, server_path / name, path,
+            on_done=lambda: self.action_refresh(use_cache=True, on_done=refreshed))
 
     def action_upload_here(self):
         server, server_path, client_path = self.get_location_by_index(self.selected)
@@ -1173,28 +2427,26 @@ class Command:
         path = dlg_file(True, '', path, '')
         if path is None:
             return
-        self.store_file(server, server_path / Path(os.path.basename(path)), Path(path))
-        self.action_refresh()
+        self.store_file(server, server_path / Path(os.path.basename(path)), Path(path),
+            on_done=lambda: self.action_refresh(use_cache=True))
 
     def remove_file(self, server, server_path, client_path):
-        with CommonClient(server) as client:
-            self.login(client, server)
+        with self.pool.client(server) as client:
             client.delete(str(server_path))
+        self.listings.remove_entry(server_alias(server), server_path.parent, server_path.name)
 
     def action_remove_file(self):
         res = msg_box(_("Do you really want to remove file?"), MB_YESNO+MB_ICONQUESTION)
         if res == ID_YES:
-            try:
-                self.remove_file(*self.get_location_by_index(self.selected))
-                server, server_path, _x = self.get_location_by_index(self.selected)
+            path_info = server, server_path, _x = self.get_location_by_index(self.selected)
+            index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
+
+            def removed(result):
                 show_log("[×] Removed", server_address(server) + str(server_path))
-                index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
                 self.refresh_node(index)
                 self.select_node_parent(index)
-            except Exception as ex:
-                show_log("Remove file", str(ex))
-                if SHOW_EX:
-                    raise
+
+            self.run("Remove file", self.remove_file, *path_info, on_done=removed)
 
     def action_new_dir(self):
         server, server_path, client_path = self.get_location_by_index(
@@ -1207,65 +2459,234 @@ class Command:
         if not dir_info:
             return
         name = dir_info[0]
-        try:
-            with CommonClient(server) as client:
-                self.login(client, server)
-                client.mkd(str(server_path / name))
-        except Exception as ex:
-            show_log("Create dir", str(ex))
-            if SHOW_EX:
-                raise
-        self.refresh_node(self.selected)
-        self.select_node(self.selected, str(server_path / name))
-        self.save_to_history(str(server_path / name))
+        node = self.selected
 
-    def remove_directory_recursive(self, client, path):
-        if app_proc(PROC_GET_ESCAPE, ""):
-            raise Exception("Stopped by user")
+        def refreshed():
+            self.select_node(node, str(server_path / name))
+            self.save_to_history(str(server_path / name))
+
+        self.run("Create dir", self.create_dir, server, server_path / name,
+            on_done=lambda result: self.refresh_node(node, on_done=refreshed))
+
+    def create_dir(self, server, server_path):
+        with self.pool.client(server) as client:
+            client.mkd(str(server_path))
+        self.listings.set_entry(server_alias(server), server_path.parent, server_path.name,
+            dict(type="dir"))
+
+    def remove_dir_tree(self, server, path):
+        """
+        Remove dir with subdirs: dirs are read level by level by several connections,
+        then files are removed (SFTP requests are pipelined), then dirs, deepest first
+        """
+        if self.remove_dir_shell(server, path):
+            return
 
-        server, server_path, client_path = self.get_location_by_index(
-            self.selected)
+        task = current_task()
+        batch = Batch(task)
+        started = time.monotonic()
+        workers = self.batch_workers(server)
+
+        def remove_files(paths):
+            def removed(path):
+                check_cancelled()
+                batch.advance()
+            with self.pool.client(server) as client:
+                client.delete_many(paths, removed)
+
+        def remove_dirs(paths):
+            with self.pool.client(server) as client:
+                for path in paths:
+                    check_cancelled()
+                    client.rmd(path)
+
+        def run_parts(fn, paths):
+            # each connection handles its part of paths
+            parts = [paths[i::workers] for i in range(min(workers, len(paths)))]
+            futures = [executor.submit(in_task, SubTask(task), fn, part) for part in parts]
+            for future in futures:
+                future.result()
+
+        levels = [[path]]
+        files = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                engine.post(msg_status, _("Reading ftp dirs: {}").format(sum(map(len, levels))))
+                listings = [(dir_path, executor.submit(in_task, SubTask(task),
+                                self.list_dir, server, dir_path, False))
+                            for dir_path in levels[-1]]
+                level = []
+                for dir_path, future in listings:
+                    for name, facts in future.result():
+                        if facts["type"] == "dir" and name not in (".", ".."):
+                            level.append(dir_path / name)
+                        elif facts["type"] == "file":
+                            files.append(str(dir_path / name))
+                if not level:
+                    break
+                levels.append(level)
 
-        for name, facts in tuple(client.mlsd(path, server_use_list(server))):
-            if facts["type"] == "dir":
-                msg_status(_("Removing ftp dir: ") + str(path / name), True)
-                self.remove_directory_recursive(client, path / name)
-            elif facts["type"] == "file":
-                msg_status(_("Removing ftp file: ") + str(path / name), True)
-                client.delete(str(path / name))
-        msg_status(_("Removing ftp dir: ") + str(path), True)
-        client.rmd(str(path))
+            batch.add(len(files))
+            engine.post(msg_status, _("Removing ftp files: {}").format(len(files)))
+            run_parts(remove_files, files)
+            for level in reversed(levels):
+                run_parts(remove_dirs, [str(dir_path) for dir_path in level])
+
+        alias = server_alias(server)
+        self.listings.invalidate(alias, path, recursive=True)
+        self.listings.remove_entry(alias, path.parent, path.name)
+        elapsed = max(time.monotonic() - started, 0.001)
+        show_log("[×] Removed dir", "{}{}: {} files, {} dirs, {:.1f} files/s".format(
+            server_address(server), path, len(files), sum(map(len, levels)), len(files) / elapsed))
+
+    def shell_tools(self, server, client):
+        """
+        Tools from SHELL_TOOLS, which can be run on server. They are checked once; set
+        is empty, if it's not SFTP server with "shell" option, or exec is not allowed.
+        """
+        if not isinstance(client, SFTP) or not server_shell(server):
+            return set()
+        alias = server_alias(server)
+        tools = self.shells.get(alias)
+        if tools is None:
+            try:
+                # "command -v" of POSIX sh tells only about one name
+                status, out, err = client.exec_command(
+                    'for t in {}; do command -v "$t" >/dev/null && echo "$t"; done'.format(
+                        " ".join(SHELL_TOOLS)))
+                tools = {line.strip() for line in out.splitlines()} & set(SHELL_TOOLS)
+            except paramiko.SSHException as ex:
+                show_log("[shell] Exec is not allowed", "{}: {}".format(server_address(server), ex))
+                tools = set()
+            self.shells[alias] = tools
+            show_log("[shell] Tools", "{}: {}".format(server_address(server), ", ".join(sorted(tools)) or "-"))
+        return tools
+
+    def remove_dir_shell(self, server, path):
+        """ Remove dir by "rm -rf" on server, if it's possible """
+        with self.pool.client(server) as client:
+            if "rm" not in self.shell_tools(server, client):
+                return False
+            status, out, err = client.exec_command("rm -rf -- " + shlex.quote(str(path)))
+        if status != 0:
+            show_log("[shell] rm -rf", "{}{}: {}".format(server_address(server), path, err.strip()))
+            return False
+        alias = server_alias(server)
+        self.listings.invalidate(alias, path, recursive=True)
+        self.listings.remove_entry(alias, path.parent, path.name)
+        show_log("[×] Removed dir (shell)", server_address(server) + str(path))
+        return True
+
+    def walk_dir(self, server, path):
+        """ Yield (dir path, name, facts) for all items of dir and subdirs """
+        dirs = [path]
+        while dirs:
+            dir_path = dirs.pop(0)
+            for name, facts in self.list_dir(server, dir_path, use_cache=False):
+                check_cancelled()
+                if facts["type"] == "dir" and name not in (".", ".."):
+                    dirs.append(dir_path / name)
+                yield dir_path, name, facts
+
+    def dir_size(self, server, path):
+        """ Total size of files in dir with subdirs, by "du" on server if possible """
+        with self.pool.client(server) as client:
+            if "du" in self.shell_tools(server, client):
+                for command, unit in (("du -sb -- ", 1), ("du -sk -- ", 1024)):
+                    status, out, err = client.exec_command(command + shlex.quote(str(path)))
+                    if status == 0 and out.split() and out.split()[0].isdigit():
+                        return int(out.split()[0]) * unit
+        return sum(int(facts.get("size") or 0)
+                   for _x, _xx, facts in self.walk_dir(server, path) if facts["type"] == "file")
+
+    def action_dir_size(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+
+        def done(size):
+            show_log("[i] Dir size", "{}{}: {} bytes ({:.2f} MB)".format(
+                server_address(server), server_path, size, size / 1024 / 1024))
+
+        self.run("Dir size", self.dir_size, server, server_path, on_done=done)
+
+    def file_checksum(self, server, path):
+        """ sha256 of file, by "sha256sum" on server if possible, else file is read """
+        with self.pool.client(server) as client:
+            if "sha256sum" in self.shell_tools(server, client):
+                status, out, err = client.exec_command("sha256sum -- " + shlex.quote(str(path)))
+                if status == 0 and out.split():
+                    return out.split()[0]
+            h = hashlib.sha256()
+
+            def update(data):
+                check_cancelled()
+                h.update(data)
+
+            client.retrbinary("RETR " + str(path), update)
+            return h.hexdigest()
+
+    def action_checksum(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        self.run("Checksum", self.file_checksum, server, server_path,
+            on_done=lambda h: show_log("[i] SHA-256", "{}{}: {}".format(server_address(server), server_path, h)))
+
+    def find_files(self, server, path, mask):
+        """
+        Show in log files of dir and subdirs, which match the mask. Uses "find" on
+        server if possible.
+        """
+        title = "[find] " + mask
+        count = 0
+        with self.pool.client(server) as client:
+            if "find" in self.shell_tools(server, client):
+                command = "find {} -type f -name {}".format(shlex.quote(str(path)), shlex.quote(mask))
+                for line in client.exec_lines(command):
+                    check_cancelled()
+                    show_log(title, server_address(server) + line)
+                    count += 1
+                # non-zero status can be given for not readable subdirs
+                if client.exit_status == 0 or count:
+                    return count
+                show_log(title, "find failed, reading dirs")
+        for dir_path, name, facts in self.walk_dir(server, path):
+            if facts["type"] == "file" and fnmatch.fnmatch(name, mask):
+                show_log(title, server_address(server) + str(dir_path / name))
+                count += 1
+        return count
+
+    def action_find_files(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        mask = dlg_input(_("Find files (mask):"), "*")
+        if not mask:
+            return
+        self.run("Find files", self.find_files, server, server_path, mask,
+            on_done=lambda count: msg_status(_("Found files: {}").format(count)))
 
     def action_remove_dir(self):
-        app_proc(PROC_SET_ESCAPE, "0")
         server, server_path, _x = self.get_location_by_index(self.selected)
         res = msg_box(_("Do you really want to remove directory?"), MB_YESNO+MB_ICONQUESTION)
         if res == ID_YES:
-            try:
-                with CommonClient(server) as client:
-                    self.login(client, server)
-                    self.remove_directory_recursive(client, server_path)
-                    show_log("[×] Removed", server_address(server) + str(server_path))
-                    index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
-                    tree_proc(self.tree, TREE_ITEM_DELETE, self.selected)
-                    self.refresh_node(index)
-                    self.select_node_parent(index)
-            except Exception as ex:
-                show_log("Remove dir", str(ex))
-                if SHOW_EX:
-                    raise
+            node = self.selected
+            index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, node)['parent']
+
+            def removed(result):
+                self.node_delete(node)
+                self.refresh_node(index)
+                self.select_node_parent(index)
+
+            self.transfer("Remove dir", server, server_path,
+                self.remove_dir_tree, server, server_path, on_done=removed, bulk=True)
 
     def action_open_file(self):
         path_info = server, server_path, client_path = \
             self.get_location_by_index(self.selected)
-        try:
-            self.retrieve_file(*path_info)
-            show_log("[↓] Downloaded", server_address(server) + str(server_path))
+
+        def downloaded(cached):
+            if not cached:
+                show_log("[↓] Downloaded", server_address(server) + str(server_path))
             file_open(str(client_path), options='/nozip /nontext-view-hex')
-        except Exception as ex:
-            show_log("Download file", str(ex))
-            if SHOW_EX:
-                raise
+
+        self.transfer("Download file", server, server_path,
+            self.retrieve_file, *path_info, True, on_done=downloaded)
 
     def action_get_properties(self):
         def convert_size(size_bytes):
@@ -1312,20 +2733,85 @@ class Command:
 
         server_path_ = get_filedir(server_path)
 
-        with CommonClient(server) as client:
-            self.login(client, server)
-            path_list = sorted(
-                    client.mlsd(server_path_, server_use_list(server)),
-                    key=lambda p: (p[1]["type"], p[0])
-                )
+        def show_info(path_list):
+            dat_ = ""
+            for name, facts in path_list:
+                name_ = str(server_path_ + name)
+                if (name_ == str(server_path)):
+                    dat_ = facts
+
+            msg_box(output_file_info(dat_), MB_OK+MB_ICONINFO)
+
+        self.run("Get properties", self.list_dir, server, PurePosixPath(server_path_),
+            on_done=show_info)
+
+    def measure_speed(self, server, server_path):
+        """
+        Download file without saving it, and show speed (MB/s) together with round
+        trip time. For SFTP, pipelined and one-request-at-a-time modes are compared.
+        """
+        title = "[speed] " + server_address(server) + str(server_path)
+        with self.pool.client(server) as client:
+            rtt = self.measure_rtt(client)
+
+            if isinstance(client, SFTP):
+                modes = [("pipelined", dict(pipelined=True)), ("sequential", dict(pipelined=False))]
+            else:
+                modes = [("RETR", {})]
+
+            for mode, kwargs in modes:
+                received = 0
+
+                def callback(data):
+                    nonlocal received
+                    received += len(data)
+                    check_cancelled()
+
+                t = time.monotonic()
+                client.retrbinary("RETR " + str(server_path), callback, **kwargs)
+                t = max(time.monotonic() - t, 0.001)
+                show_log(title, "RTT {:.0f} ms, {}: {:.2f} MB/s ({} bytes in {:.2f} sec)".format(
+                    rtt * 1000, mode, received / t / 1024 / 1024, received, t))
+
+    def measure_rtt(self, client):
+        t = time.monotonic()
+        for i in range(SPEED_PINGS):
+            client.noop()
+        return (time.monotonic() - t) / SPEED_PINGS
+
+    def measure_upload_speed(self, server, dir_path):
+        """
+        Upload test file of random data to the dir, show speed, remove the file
+        """
+        server_path = dir_path / SPEED_TEST_NAME
+        title = "[speed] " + server_address(server) + str(server_path)
+        data = os.urandom(SPEED_TEST_SIZE)
+        with self.pool.client(server) as client:
+            rtt = self.measure_rtt(client)
+
+            if isinstance(client, SFTP):
+                modes = [("pipelined", dict(pipelined=True)), ("sequential", dict(pipelined=False))]
+            else:
+                modes = [("STOR", {})]
 
-        dat_ = ""
-        for name, facts in path_list:
-            name_ = str(server_path_ + name)
-            if (name_ == str(server_path)):
-                dat_ = facts
+            try:
+                for mode, kwargs in modes:
+                    t = time.monotonic()
+                    client.storbinary("STOR " + str(server_path), io.BytesIO(data),
+                        callback=lambda block: check_cancelled(), **kwargs)
+                    t = max(time.monotonic() - t, 0.001)
+                    show_log(title, "RTT {:.0f} ms, {}: {:.2f} MB/s ({} bytes in {:.2f} sec)".format(
+                        rtt * 1000, mode, len(data) / t / 1024 / 1024, len(data), t))
+            finally:
+                client.delete(str(server_path))
+
+    def action_measure_speed(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        self.run("Measure speed", self.measure_speed, server, server_path)
 
-        msg_box(output_file_info(dat_), MB_OK+MB_ICONINFO)
+    def action_measure_upload_speed(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        self.run("Measure speed", self.measure_upload_speed, server, server_path)
 
     def action_copy_path(self):
         server, server_path, _x = self.get_location_by_index(self.selected)
@@ -1345,6 +2831,260 @@ class Command:
         app_proc(PROC_SET_CLIP, link)
         msg_status(_("Link copied to clipboard: " + link), True)
 
+    def download_dir(self, server, server_path, local_dir):
+        """
+        Download dir with subdirs. Dirs are read level by level, and files are
+        downloaded meanwhile, by several connections. Files with the same size and
+        modify time are skipped.
+        """
+        if self.download_dir_tar(server, server_path, local_dir):
+            return
+
+        task = current_task()
+        batch = Batch(task)
+        skipped = 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.batch_workers(server)) as executor:
+            jobs = []
+            level = [(server_path, local_dir)]
+            while level:
+                listings = [(path, local, executor.submit(in_task, SubTask(task),
+                                self.list_dir, server, path, False))
+                            for path, local in level]
+                level = []
+                for path, local, future in listings:
+                    try:
+                        local.mkdir(parents=True)
+                    except FileExistsError:
+                        pass
+                    for name, facts in future.result():
+                        if name in (".", "..") or "/" in name or "\\" in name:
+                            continue
+                        if facts["type"] == "dir":
+                            level.append((path / name, local / name))
+                        elif facts["type"] == "file":
+                            if is_same_file(local / name, facts):
+                                skipped += 1
+                                continue
+                            batch.add(1, int(facts.get("size") or 0))
+                            jobs.append(executor.submit(self.batch_job, batch, "Download file",
+                                self.download_dir_file, server, path / name, local / name, facts))
+            failed = sum(1 for job in jobs if not job.result())
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        show_log("[↓] Downloaded dir", "{}{}: {} files ({} not changed), {:.2f} MB/s, {:.1f} files/s".format(
+            server_address(server), server_path, len(jobs), skipped,
+            batch.done / elapsed / 1024 / 1024, len(jobs) / elapsed))
+        if failed:
+            raise Exception("{} files are not downloaded".format(failed))
+
+    def tar_command(self, server, client):
+        """ Options of tar on server, or None if dirs can't be sent as tar stream """
+        if not server_tar_stream(server) or "tar" not in self.shell_tools(server, client):
+            return None
+        return "-z" if server_tar_gzip(server) else ""
+
+    def download_dir_tar(self, server, server_path, local_dir):
+        """
+        Download dir as one tar stream made by "tar -c" on server, files are written
+        while it's received (without temp archives). Members, which point out of
+        local dir, and links are skipped.
+        Returns False, if server can't do it.
+        """
+        task = current_task()
+        started = time.monotonic()
+        received = 0
+        files = 0
+
+        def progress(size):
+            nonlocal received
+            received += size
+            if task is not None:
+                task.report(received)
+
+        with self.pool.client(server) as client:
+            options = self.tar_command(server, client)
+            if options is None:
+                return False
+            chan = client.exec_channel("tar -c {} -f - -C {} .".format(options, shlex.quote(str(server_path))))
+            try:
+                with chan.makefile("rb") as fin, \
+                        tarfile.open(fileobj=ChannelReader(fin, progress), mode="r|gz" if options else "r|") as tar:
+                    for member in tar:
+                        path = tar_member_path(local_dir, member.name)
+                        if path is None or not (member.isdir() or member.isfile()):
+                            show_log("[↓] Skipped tar member", member.name)
+                            continue
+                        if member.isdir():
+                            os.makedirs(str(path), exist_ok=True)
+                            continue
+                        os.makedirs(str(path.parent), exist_ok=True)
+                        with tar.extractfile(member) as fsrc, path.open(mode="wb") as fdst:
+                            for data in iter(lambda: fsrc.read(65536), b""):
+                                fdst.write(data)
+                        os.utime(str(path), (member.mtime, member.mtime))
+                        files += 1
+                        if task is not None:
+                            task.report_files(files)
+                status = chan.recv_exit_status()
+                with chan.makefile_stderr("rb") as ferr:
+                    err = ferr.read().decode("utf-8", errors="replace")
+            finally:
+                chan.close()
+        if status != 0:
+            raise Exception("tar failed: " + err.strip())
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        show_log("[↓] Downloaded dir (tar)", "{}{}: {} files, {:.2f} MB/s, {:.1f} files/s".format(
+            server_address(server), server_path, files, received / elapsed / 1024 / 1024, files / elapsed))
+        return True
+
+    def upload_dir_tar(self, server, server_path, local_dir):
+        """
+        Upload dir as one tar stream, unpacked by "tar -x" on server while it's sent.
+        Returns False, if server can't do it.
+        """
+        task = current_task()
+        started = time.monotonic()
+        sent = 0
+        files = 0
+
+        def progress(size):
+            nonlocal sent
+            sent += size
+            if task is not None:
+                task.report(sent)
+
+        def count(info):
+            nonlocal files
+            if info.isfile():
+                files += 1
+                if task is not None:
+                    task.report_files(files)
+            return info
+
+        with self.pool.client(server) as client:
+            options = self.tar_command(server, client)
+            if options is None:
+                return False
+            dest = shlex.quote(str(server_path))
+            chan = client.exec_channel("mkdir -p -- {0} && tar -x {1} -f - -C {0}".format(dest, options))
+            try:
+                with tarfile.open(fileobj=ChannelWriter(chan, progress), mode="w|gz" if options else "w|") as tar:
+                    tar.add(str(local_dir), arcname=".", filter=count)
+                chan.shutdown_write()
+                status = chan.recv_exit_status()
+                with chan.makefile_stderr("rb") as ferr:
+                    err = ferr.read().decode("utf-8", errors="replace")
+            finally:
+                chan.close()
+        alias = server_alias(server)
+        self.listings.invalidate(alias, server_path, recursive=True)
+        self.listings.invalidate(alias, server_path.parent)
+        if status != 0:
+            raise Exception("tar failed: " + err.strip())
+
+        self.listings.add_dir(alias, server_path)
+        elapsed = max(time.monotonic() - started, 0.001)
+        show_log("[↑] Uploaded dir (tar)", "{}{}: {} files, {:.2f} MB/s, {:.1f} files/s".format(
+            server_address(server), server_path, files, sent / elapsed / 1024 / 1024, files / elapsed))
+        return True
+
+    def download_dir_file(self, server, server_path, client_path, facts):
+        self.retrieve_file(server, server_path, client_path)
+        mtime = modify_timestamp(facts.get("modify"))
+        if mtime is not None:
+            # to skip it next time
+            os.utime(str(client_path), (mtime, mtime))
+
+    def action_download_dir(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        path = dlg_dir(os.path.expanduser('~'))
+        if not path:
+            return
+        local_dir = Path(path) / (server_path.name or server_address(server))
+
+        def downloaded(result):
+            msg_status(_("Dir downloaded to: ") + str(local_dir), True)
+
+        self.transfer("Download dir", server, server_path,
+            self.download_dir, server, server_path, local_dir, on_done=downloaded, bulk=True)
+
+    def upload_dir(self, server, server_path, local_dir):
+        """
+        Upload local dir with subdirs: remote dirs are created first (level by
+        level), then files are uploaded by several connections
+        """
+        if self.upload_dir_tar(server, server_path, local_dir):
+            return
+
+        task = current_task()
+        batch = Batch(task)
+        started = time.monotonic()
+        levels = collections.defaultdict(list)
+        files = []
+        for root, dirs, names in os.walk(str(local_dir)):
+            rel = Path(root).relative_to(local_dir)
+            remote = server_path.joinpath(*rel.parts)
+            levels[len(rel.parts)].append(remote)
+            for name in names:
+                path = Path(root) / name
+                files.append((path, remote / name))
+                batch.add(1, path.stat().st_size)
+
+        alias = server_alias(server)
+
+        def create_dirs(paths):
+            with self.pool.client(server) as client:
+                for path in paths:
+                    check_cancelled()
+                    if self.listings.has_dir(alias, path):
+                        continue
+                    try:
+                        client.mkd(str(path))
+                    except error_perm:
+                        pass
+                    self.listings.add_dir(alias, path)
+
+        workers = self.batch_workers(server)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self.ensure_dir_pooled(server, server_path.parent)
+            for depth in sorted(levels):
+                paths = levels[depth]
+                # few MKDs by each connection
+                parts = [paths[i::workers] for i in range(min(workers, len(paths)))]
+                for future in [executor.submit(in_task, SubTask(task), create_dirs, part) for part in parts]:
+                    future.result()
+            self.listings.invalidate(alias, server_path, recursive=True)
+            self.listings.invalidate(alias, server_path.parent)
+
+            jobs = [executor.submit(self.batch_job, batch, "Upload file",
+                        self.upload_file, server, remote, path, True)
+                    for path, remote in files]
+            failed = sum(1 for job in jobs if not job.result())
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        show_log("[↑] Uploaded dir", "{}{}: {} files, {} dirs, {:.2f} MB/s, {:.1f} files/s".format(
+            server_address(server), server_path, len(files), sum(len(paths) for paths in levels.values()),
+            batch.done / elapsed / 1024 / 1024, len(files) / elapsed))
+        if failed:
+            raise Exception("{} files are not uploaded".format(failed))
+
+    def ensure_dir_pooled(self, server, path):
+        with self.pool.client(server) as client:
+            self.ensure_dir(client, server, path)
+
+    def action_upload_dir(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        path = dlg_dir(os.path.dirname(ed.get_filename()) or os.path.expanduser('~'))
+        if not path:
+            return
+        local_dir = Path(path)
+
+        self.transfer("Upload dir", server, server_path / local_dir.name,
+            self.upload_dir, server, server_path / local_dir.name, local_dir,
+            on_done=lambda result: self.action_refresh(use_cache=True), bulk=True)
+
     def action_download_file(self):
         server, server_path, _x = self.get_location_by_index(self.selected)
         alias, __x = self.get_server_alias_path()
@@ -1371,11 +3111,222 @@ class Command:
         except OSError:
             pass
 
-        self.retrieve_file(server, server_path, Path(path_))
+        def downloaded(result):
+            if os.path.exists(path_):
+                msg_status(_("File downloaded to: ") + path_, True)
+                show_log("[↓] Downloaded", server_address(server) + str(server_path))
+
+        self.transfer("Download file", server, server_path,
+            self.retrieve_file, server, server_path, Path(path_), on_done=downloaded)
+
+    def pipe_file(self, src_server, src_path, dst_server, dst_path):
+        """
+        Copy file from one connection to another (same or other server), without
+        local file: blocks go through queue of PIPE_BLOCKS. If server gives only one
+        connection to the task, file is read to temp file first.
+        """
+        task = current_task()
+        reader_task = SubTask(task)
+        blocks = queue.Queue(maxsize=PIPE_BLOCKS)
+        progress = 0
 
-        if os.path.exists(path_):
-            msg_status(_("File downloaded to: ") + path_, True)
-            show_log("[↓] Downloaded", server_address(server) + str(server_path))
+        def put(block):
+            while True:
+                if reader_task.cancelled:
+                    raise Cancelled("Stopped")
+                try:
+                    blocks.put(block, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def callback(data):
+            nonlocal progress
+            progress += len(data)
+            if task is not None:
+                task.report(progress)
+
+        def read(client):
+            try:
+                client.retrbinary("RETR " + str(src_path), put)
+            except BaseException as ex:
+                put(ex)
+                raise
+            put(None)
+
+        def read_pooled():
+            with self.pool.client(src_server) as client:
+                read(client)
+
+        # bulk work leaves one connection for interactive work
+        needed = 3 if task is not None and task.bulk else 2
+        if src_server is dst_server and self.pool.limit(src_server) < needed:
+            with self.pool.client(src_server) as client, tempfile.TemporaryFile() as f:
+                client.retrbinary("RETR " + str(src_path), f.write)
+                f.seek(0)
+                client.storbinary("STOR " + str(dst_path), f, callback=callback)
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            reader = executor.submit(in_task, reader_task, read_pooled)
+            try:
+                with self.pool.client(dst_server) as client:
+                    try:
+                        client.storbinary("STOR " + str(dst_path), QueueReader(blocks), callback=callback)
+                    except BaseException:
+                        # error of reading (even FTP answer of source server) breaks STOR,
+                        # and its answer is not read
+                        if isinstance(client, FTP_):
+                            client._ftp.close()
+                            client.dropped = True
+                        raise
+            except BaseException:
+                reader_task.cancel()
+                self.remove_quietly(dst_server, dst_path)
+                raise
+            finally:
+                reader_task.cancel()
+            reader.result()
+
+    def remove_quietly(self, server, path):
+        """ Remove not finished file, errors are ignored """
+        try:
+            with self.pool.client(server) as client:
+                client.delete(str(path))
+        except Exception:
+            pass
+
+    def copy_file(self, server, src_path, dst_path):
+        """
+        Copy file on server: by SFTP "copy-data", FTP "SITE CPFR/CPTO", or "cp" on
+        server (with "shell" option), else through pipe between two connections
+        """
+        with self.pool.client(server) as client:
+            done = client.copy_file(str(src_path), str(dst_path))
+            if not done and "cp" in self.shell_tools(server, client):
+                status, out, err = client.exec_command("cp -p -- {} {}".format(
+                    shlex.quote(str(src_path)), shlex.quote(str(dst_path))))
+                done = status == 0
+        if not done:
+            self.pipe_file(server, src_path, server, dst_path)
+        self.listings.invalidate(server_alias(server), dst_path.parent)
+
+    def copy_dir(self, server, src_path, dst_path):
+        """ Copy dir with subdirs on server, by "cp -R" if possible """
+        with self.pool.client(server) as client:
+            if "cp" in self.shell_tools(server, client):
+                status, out, err = client.exec_command("cp -R -p -- {} {}".format(
+                    shlex.quote(str(src_path)), shlex.quote(str(dst_path))))
+                if status == 0:
+                    self.listings.invalidate(server_alias(server), dst_path.parent)
+                    return
+                show_log("[shell] cp -R", err.strip())
+            self.ensure_dir(client, server, dst_path)
+            self.listings.add_dir(server_alias(server), dst_path)
+
+        batch = Batch(current_task())
+        # copy through pipe takes two connections
+        with ThreadPoolExecutor(max_workers=max(1, self.batch_workers(server) // 2)) as executor:
+            jobs = []
+            for dir_path, name, facts in self.walk_dir(server, src_path):
+                target = dst_path / dir_path.relative_to(src_path) / name
+                if facts["type"] == "dir" and name not in (".", ".."):
+                    self.create_dir(server, target)
+                elif facts["type"] == "file":
+                    batch.add(1, int(facts.get("size") or 0))
+                    jobs.append(executor.submit(self.batch_job, batch, "Copy file",
+                        self.copy_file, server, dir_path / name, target))
+            failed = sum(1 for job in jobs if not job.result())
+        self.listings.invalidate(server_alias(server), dst_path.parent)
+        if failed:
+            raise Exception("{} files are not copied".format(failed))
+
+    def copy_between(self, src_server, src_path, dst_server, dst_path):
+        """
+        Copy file to other server: directly (FXP) if both are FTP and allow it, else
+        through pipe between two connections
+        """
+        if not self.listings.has_dir(server_alias(dst_server), dst_path.parent):
+            self.ensure_dir_pooled(dst_server, dst_path.parent)
+        pair = (server_alias(src_server), server_alias(dst_server))
+        done = False
+        if server_type(src_server) == server_type(dst_server) == "ftp" and pair not in self.no_fxp:
+            with self.pool.client(src_server) as src, self.pool.client(dst_server) as dst:
+                done = src.fxp_to(dst, str(src_path), str(dst_path))
+            if not done:
+                self.no_fxp.add(pair)
+                show_log("[FXP] Not allowed", "{} -> {}, file is sent through plugin".format(*pair))
+        if not done:
+            self.pipe_file(src_server, src_path, dst_server, dst_path)
+        self.listings.invalidate(server_alias(dst_server), dst_path.parent)
+
+    def copy_dir_between(self, src_server, src_path, dst_server, dst_path):
+        """ Copy dir with subdirs to other server, files are copied in parallel """
+        self.ensure_dir_pooled(dst_server, dst_path)
+        self.listings.add_dir(server_alias(dst_server), dst_path)
+        batch = Batch(current_task())
+        # each file takes connection to both servers
+        workers = min(self.batch_workers(src_server), self.batch_workers(dst_server))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = []
+            for dir_path, name, facts in self.walk_dir(src_server, src_path):
+                target = dst_path / dir_path.relative_to(src_path) / name
+                if facts["type"] == "dir" and name not in (".", ".."):
+                    self.ensure_dir_pooled(dst_server, target)
+                    self.listings.add_dir(server_alias(dst_server), target)
+                elif facts["type"] == "file":
+                    batch.add(1, int(facts.get("size") or 0))
+                    jobs.append(executor.submit(self.batch_job, batch, "Copy file",
+                        self.copy_between, src_server, dir_path / name, dst_server, target))
+            failed = sum(1 for job in jobs if not job.result())
+        self.listings.invalidate(server_alias(dst_server), dst_path.parent)
+        if failed:
+            raise Exception("{} files are not copied".format(failed))
+
+    def action_copy_to_server(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        is_dir = self.node_kind(self.selected) == NODE_DIR
+        servers = [s for s in self.options["servers"] if server_alias(s) != server_alias(server)]
+        if not servers:
+            msg_status(_("No other servers"))
+            return
+        res = dlg_menu(DMENU_LIST, [server_alias(s) for s in servers], caption=_('Copy to server'))
+        if res is None:
+            return
+        target = servers[res]
+        path = dlg_input(_("Copy to dir on {}:").format(server_alias(target)), str(server_path.parent))
+        if not path:
+            return
+        dst_path = PurePosixPath(path) / server_path.name
+
+        def done(result):
+            show_log("[→] Copied", "{}{} to {}{}".format(
+                server_address(server), server_path, server_address(target), dst_path))
+
+        self.transfer("Copy to server", server, server_path,
+            self.copy_dir_between if is_dir else self.copy_between,
+            server, server_path, target, dst_path, on_done=done, bulk=is_dir)
+
+    def action_duplicate(self):
+        server, server_path, _x = self.get_location_by_index(self.selected)
+        is_dir = self.node_kind(self.selected) == NODE_DIR
+        stem, ext = os.path.splitext(server_path.name)
+        if is_dir:
+            stem, ext = server_path.name, ""
+        res = dlg_input(_("Duplicate: "), stem + " copy" + ext)
+        if not res:
+            return
+        new_path = server_path.parent / res
+        index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
+
+        def done(result):
+            show_log("[+] Duplicated", "{}{} to {}".format(server_address(server), server_path, new_path))
+            self.refresh_node(index)
+            self.select_node(index, str(new_path))
+
+        self.transfer("Duplicate", server, server_path,
+            self.copy_dir if is_dir else self.copy_file, server, server_path, new_path,
+            on_done=done, bulk=is_dir)
 
     def action_backup_file(self):
         server, server_path, _x = self.get_location_by_index(self.selected)
@@ -1390,26 +3341,31 @@ class Command:
         if res is None:
             return
         else:
-            try:
-                new_path_server = get_filedir_(server_path) + res
-                self.retrieve_file(server, server_path, _x)
-                new_path = get_filedir_(_x) + res
-                os.rename(str(_x), str(new_path))
-                self.store_file(server, Path(new_path_server), Path(new_path))
+            new_path_server = get_filedir_(server_path) + res
+            index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
+
+            def done(result):
                 show_log("[!] Backup", server_address(server) + str(server_path) + " to " + new_path_server)
-                index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
                 self.refresh_node(index)
                 self.select_node(index, new_path_server)
-            except Exception as ex:
-                show_log("Backup file", str(ex))
-                if SHOW_EX:
-                    raise
+
+            self.run("Backup file", self.copy_file, server, server_path, PurePosixPath(new_path_server),
+                on_done=done)
 
     def rename_file_dir(self, server, server_path, client_path, new_name):
-        with CommonClient(server) as client:
-            self.login(client, server)
+        with self.pool.client(server) as client:
             client.rename(str(server_path), str(new_name))
 
+        alias = server_alias(server)
+        new_path = PurePosixPath(new_name)
+        facts = self.listings.get_entry(alias, server_path.parent, server_path.name)
+        self.listings.remove_entry(alias, server_path.parent, server_path.name)
+        self.listings.invalidate(alias, server_path, recursive=True)
+        if facts is not None:
+            self.listings.set_entry(alias, new_path.parent, new_path.name, facts)
+        else:
+            self.listings.invalidate(alias, new_path.parent)
+
     def action_rename_file_dir(self):
         server, server_path, _x = self.get_location_by_index(self.selected)
         def get_filedir_(dat_):
@@ -1422,17 +3378,17 @@ class Command:
         if res is None:
             return
         else:
-            try:
-                newname = get_filedir_(server_path) + res
-                self.rename_file_dir(*self.get_location_by_index(self.selected), newname)
+            newname = get_filedir_(server_path) + res
+            index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
+
+            def renamed(result):
                 show_log("[!] Renamed", server_address(server) + str(server_path))
-                index = tree_proc(self.tree, TREE_ITEM_GET_PROPS, self.selected)['parent']
                 self.refresh_node(index)
                 self.select_node(index, newname)
-            except Exception as ex:
-                show_log("Rename file/dir", str(ex))
-                if SHOW_EX:
-                    raise
+
+            self.run("Rename file/dir", self.rename_file_dir,
+                *self.get_location_by_index(self.selected), newname,
+                on_done=renamed)
 
     def select_node(self, parent, path):
         prop_list = tree_proc(self.tree, TREE_ITEM_ENUM_EX, parent)
@@ -1452,18 +3408,18 @@ class Command:
             json.dump(self.options, fout, indent=2)
 
     def is_selected_server(self):
-        info = self.get_info(self.selected)
-        return info.image == NODE_SERVER
+        kind = self.node_kind(self.selected)
+        return kind == NODE_SERVER
 
     def tree_on_menu(self, id_dlg, id_ctl, data='', info=''):
         self.generate_context_menu()
         menu_proc(self.h_menu, MENU_SHOW, command='')
 
     def tree_on_click_dbl(self, id_dlg, id_ctl, data='', info=''):
-        info = self.get_info(self.selected)
-        if info.image in (NODE_SERVER, NODE_DIR):
-            self.action_refresh()
-        elif info.image == NODE_FILE:
+        kind = self.node_kind(self.selected)
+        if kind in (NODE_SERVER, NODE_DIR):
+            self.action_refresh(use_cache=True)
+        elif kind == NODE_FILE:
             self.action_open_file()
             self.save_to_history(False)
 
@@ -1473,10 +3429,10 @@ class Command:
             self.tree_on_click_dbl(id_dlg, 0, '', '')
         #Del pressed
         elif id_ctl == VK_DELETE:
-            info = self.get_info(self.selected)
-            if info.image == NODE_FILE:
+            kind = self.node_kind(self.selected)
+            if kind == NODE_FILE:
                 self.action_remove_file()
-            elif info.image == NODE_DIR:
+            elif kind == NODE_DIR:
                 self.action_remove_dir()
         #F5 or Ctrl+R pressed
         elif (id_ctl == VK_F5) or (data == 'c' and id_ctl == 0x52):
@@ -1484,8 +3440,11 @@ class Command:
             return False
         #F2 pressed
         elif id_ctl == VK_F2:
-            info = self.get_info(self.selected)
-            if (info.image == NODE_FILE or info.image == NODE_DIR):
+            kind = self.node_kind(self.selected)
+            if (kind == NODE_FILE or kind == NODE_DIR):
                 self.action_rename_file_dir()
-            if info.image == NODE_SERVER:
+            if kind == NODE_SERVER:
                 self.action_rename_server()
+        #Esc pressed
+        elif id_ctl == VK_ESCAPE:
+            self.stop_operations()
@@ -0,0 +1,294 @@
+import collections
+import hashlib
+import json
+import os
+import posixpath
+import threading
+import time
+
+from .pathlib import Path
+
+# size of blocks, which are hashed to find changed parts of file
+BLOCK_SIZE = 65536
+# not finished download, which was changed recently, can be still running (sec)
+PART_ACTIVE_TIME = 600
+
+
+class ListingCache:
+    """
+    Directory listings (results of mlsd) keyed by (server alias, remote path).
+    Entries live for `ttl` seconds, least recently used are dropped
+    when there are more than `max_entries`.
+    Also remembers dirs, which are known to exist (they don't expire).
+    """
+
+    def __init__(self, ttl=30, max_entries=200):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # (alias, path) -> (time, {name: facts})
+        self.dirs = {}  # alias -> {path, ...}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, alias, path):
+        key = (alias, str(path))
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and time.time() - item[0] > self.ttl:
+                del self.entries[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(item[1].items())
+
+    def put(self, alias, path, listing):
+        self.add_dir(alias, path)
+        path = str(path)
+        prefix = path.rstrip("/") + "/"
+        names = {name for name, facts in listing
+                 if facts.get("type") == "dir" and name not in (".", "..")}
+        with self.lock:
+            dirs = self.dirs[alias]
+            # subdirs, which are not in fresh listing, are removed (with their subdirs)
+            dirs.difference_update([d for d in dirs if d != path and d.startswith(prefix)
+                                    and d[len(prefix):].split("/")[0] not in names])
+            dirs.update(prefix + name for name in names)
+        if self.ttl <= 0:
+            return
+        key = (alias, str(path))
+        with self.lock:
+            self.entries[key] = (time.time(), collections.OrderedDict(listing))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, alias, path=None, recursive=False):
+        with self.lock:
+            if path is None:
+                self.dirs.pop(alias, None)
+                keys = [k for k in self.entries if k[0] == alias]
+            else:
+                path = str(path)
+                prefix = path.rstrip("/") + "/"
+                keys = [k for k in self.entries
+                        if k[0] == alias and (k[1] == path or recursive and k[1].startswith(prefix))]
+            for key in keys:
+                del self.entries[key]
+
+    def get_entry(self, alias, dir_path, name):
+        with self.lock:
+            item = self.entries.get((alias, str(dir_path)))
+            if item is not None:
+                return item[1].get(name)
+
+    def set_entry(self, alias, dir_path, name, facts):
+        """ Patch cached listing after our own change, if listing is cached """
+        with self.lock:
+            item = self.entries.get((alias, str(dir_path)))
+            if item is not None:
+                item[1][name] = facts
+        if facts.get("type") == "dir":
+            self.add_dir(alias, posixpath.join(str(dir_path), name))
+
+    def remove_entry(self, alias, dir_path, name):
+        with self.lock:
+            item = self.entries.get((alias, str(dir_path)))
+            if item is not None:
+                item[1].pop(name, None)
+        self.forget_dir(alias, posixpath.join(str(dir_path), name))
+
+    def add_dir(self, alias, path):
+        """ Remember that dir (and so its parents) exists """
+        path = str(path)
+        with self.lock:
+            dirs = self.dirs.setdefault(alias, {"/"})
+            while path not in dirs:
+                dirs.add(path)
+                path = posixpath.dirname(path)
+
+    def has_dir(self, alias, path):
+        with self.lock:
+            return str(path) in self.dirs.get(alias, {"/"})
+
+    def forget_dir(self, alias, path):
+        """ Dir is removed or renamed, with its subdirs """
+        path = str(path)
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            dirs = self.dirs.get(alias)
+            if dirs:
+                dirs.difference_update([d for d in dirs if d == path or d.startswith(prefix)])
+                dirs.add("/")
+
+    def stats(self):
+        return "hits: {}, misses: {}".format(self.hits, self.misses)
+
+
+class FileCache:
+    """
+    Index of downloaded files under `root`: remote size/modify time, local size/mtime,
+    hash and time of last use. If `filename` is given, index is saved there and
+    survives restart. Least recently used files are removed, when their total size
+    is more than `max_bytes`. Not finished downloads (files with `part_suffix`) are
+    not in the index, but they are counted and removed too.
+    """
+
+    def __init__(self, root, max_bytes=None, filename=None, part_suffix=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.part_suffix = part_suffix
+        self.entries = {}  # relative path -> {size, modify, local_size, local_mtime, hash, blocks, atime}
+        self.lock = threading.Lock()
+        if filename is not None and filename.exists():
+            try:
+                with filename.open(encoding="utf-8") as fin:
+                    self.entries = json.load(fin)
+            except ValueError:
+                pass
+            for key in list(self.entries):
+                if not (self.root / key).exists():
+                    del self.entries[key]
+
+    def key(self, path):
+        return Path(path).relative_to(self.root).as_posix()
+
+    def put(self, path, remote):
+        """ Remember `remote` facts (size, modify) of the server file, equal to local file """
+        try:
+            key = self.key(path)
+        except ValueError:
+            return
+        st = path.stat()
+        hash_, blocks = file_hashes(path)
+        entry = dict(remote, local_size=st.st_size, local_mtime=st.st_mtime,
+            hash=hash_, blocks=blocks, atime=time.time())
+        with self.lock:
+            self.entries[key] = entry
+        self.save()
+
+    def get(self, path):
+        try:
+            key = self.key(path)
+        except ValueError:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else dict(entry)
+
+    def remove(self, path):
+        try:
+            key = self.key(path)
+        except ValueError:
+            return
+        with self.lock:
+            if self.entries.pop(key, None) is None:
+                return
+        self.save()
+
+    def is_fresh(self, path, remote):
+        """
+        Local file is not changed, and server file has the same size and modify time.
+        If only local mtime is changed, file content is compared by hash.
+        """
+        try:
+            key = self.key(path)
+            st = path.stat()
+        except (ValueError, OSError):
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or remote["modify"] is None or \
+                entry["size"] != remote["size"] or entry["modify"] != remote["modify"] or \
+                entry["local_size"] != st.st_size:
+            return False
+        if entry["local_mtime"] != st.st_mtime and entry["hash"] != file_hashes(path)[0]:
+            return False
+        with self.lock:
+            entry["local_mtime"] = st.st_mtime
+            entry["atime"] = time.time()
+        self.save()
+        return True
+
+    def evict(self, keep=()):
+        """ Remove least recently used files, except `keep` ones; returns their paths """
+        if not self.max_bytes:
+            return []
+        keep = {str(Path(p)) for p in keep}
+        parts = self.parts()
+        removed = []
+        now = time.time()
+        with self.lock:
+            # (time of last use, path, size, key in index)
+            items = [(e["atime"], self.root / key, e["local_size"], key) for key, e in self.entries.items()]
+            items += [(mtime, path, size, None) for path, size, mtime in parts]
+            total = sum(item[2] for item in items)
+            for atime, path, size, key in sorted(items, key=lambda item: item[0]):
+                if total <= self.max_bytes:
+                    break
+                if str(path) in keep or key is None and now - atime < PART_ACTIVE_TIME:
+                    continue
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue
+                if key is not None:
+                    del self.entries[key]
+                total -= size
+                removed.append(path)
+        if removed:
+            self.save()
+        return removed
+
+    def parts(self):
+        """ [(path, size, mtime), ...] of not finished downloads """
+        if not self.part_suffix:
+            return []
+        result = []
+        for root, _dirs, names in os.walk(str(self.root)):
+            for name in names:
+                if name.endswith(self.part_suffix):
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    result.append((Path(root) / name, st.st_size, st.st_mtime))
+        return result
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self.lock, self.filename.open(mode="w", encoding="utf-8") as fout:
+            json.dump(self.entries, fout, indent=2)
+
+
+def file_hashes(path):
+    """ sha256 of file, and short hashes of its blocks of BLOCK_SIZE """
+    h = hashlib.sha256()
+    blocks = []
+    with path.open(mode="rb") as fin:
+        for data in iter(lambda: fin.read(BLOCK_SIZE), b""):
+            h.update(data)
+            blocks.append(hashlib.sha1(data).hexdigest()[:16])
+    return h.hexdigest(), blocks
+
+
+def changed_ranges(old_blocks, new_blocks, size):
+    """ [(offset, length), ...] of blocks, which are different in new file """
+    ranges = []
+    for i, block in enumerate(new_blocks):
+        if i < len(old_blocks) and old_blocks[i] == block:
+            continue
+        start = i * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, size)
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+        else:
+            ranges.append((start, end - start))
+    return ranges
@@ -8,11 +8,12 @@ VK_ENTER = 13
 
 def dialog_server_props(s_type, s_host, s_port,
                         s_username, s_password, s_dir, s_timeout,
-                        s_label, s_uselist, s_pkey):
+                        s_label, s_uselist, s_pkey, s_maxconn):
     
     names = [   'type_ftp', 'type_sftp',    'host', 'port',
                 'username', 'pass',         'dir',  'timeout',
-                'menu_ind', 'use_list',     'pkey', 'ask']
+                'menu_ind', 'use_list',     'pkey', 'ask',
+                'max_conn']
     future_result = [None] # m_ok() fills    
                                 
     scale_p, scale_font_p = app_proc(PROC_CONFIG_SCALE_GET, '')
@@ -60,6 +61,7 @@ def dialog_server_props(s_type, s_host, s_port,
         s_label = vals['menu_ind']
         s_uselist = vals['use_list']=='1'
         s_pkey = vals['pkey']
+        s_maxconn = vals['max_conn']
         
         if not s_host:
             msg_box(_('Fill the Host field'), MB_OK)
@@ -68,7 +70,7 @@ def dialog_server_props(s_type, s_host, s_port,
             msg_box(_('Fill the Username field'), MB_OK)
             return
             
-        future_result[0] = (s_type, s_host, s_port, s_username, s_password, s_dir, s_timeout, s_label, s_uselist, s_pkey)
+        future_result[0] = (s_type, s_host, s_port, s_username, s_password, s_dir, s_timeout, s_label, s_uselist, s_pkey, s_maxconn)
         
         dlg_proc(h, DLG_HIDE)
             
@@ -373,6 +375,33 @@ def dialog_server_props(s_type, s_host, s_port,
                 'val': s_timeout,
     })                       
                     
+    # max connections
+    prev_name,name = name, 'max_conn_label'
+    n = dlg_proc(h, DLG_CTL_ADD, 'label')
+    dlg_proc(h, DLG_CTL_PROP_SET, index=n, prop={
+                **label_defaults,
+                'name': name,
+                'p': 'misc_group',
+                'a_l': ('', '['), 
+                'a_t': (prev_name,']'),
+                'cap': _('Max connections (0 - default): '),  
+    })
+    prev_name,name = name, 'max_conn'
+    n = dlg_proc(h, DLG_CTL_ADD, 'spinedit')
+    dlg_proc(h, DLG_CTL_PROP_SET, index=n, prop={
+                'name': name,
+                'p': 'misc_group',
+                'a_l': (prev_name, ']'),
+                'a_t': (prev_name,'-'),
+                'a_r': None,
+                'sp_a': round(3*scale),
+                'w_min': round(50*scale),
+                'ex0': 0, # min
+                'ex1': 16, # max
+                'ex2': 1, # increment
+                'val': s_maxconn,
+    })                       
+                    
     # menu label
     prev_name,name = name, 'menu_ind_label'
     n = dlg_proc(h, DLG_CTL_ADD, 'label')
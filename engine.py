@@ -0,0 +1,229 @@
+import threading
+import queue
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from cudatext import timer_proc, TIMER_START, TIMER_STOP
+
+# how often results of background work are handled in UI thread (msec)
+DISPATCH_INTERVAL = 50
+# max time of one dispatch tick, rest of calls wait for next tick (sec)
+DISPATCH_BUDGET = 0.05
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+def is_main_thread():
+    return threading.current_thread() is threading.main_thread()
+
+
+def current_task():
+    return getattr(_local, "task", None)
+
+
+def check_cancelled():
+    task = current_task()
+    if task is not None and task.cancelled:
+        raise Cancelled("Stopped by user")
+
+
+def sleep(seconds):
+    """ time.sleep, which is interrupted when current task is cancelled """
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        check_cancelled()
+        time.sleep(min(0.1, deadline - time.monotonic()))
+    check_cancelled()
+
+
+def in_task(task, fn, *args):
+    """
+    Call fn(*args) in a helper thread of the task, so check_cancelled() works there
+    """
+    _local.task = task
+    try:
+        return fn(*args)
+    finally:
+        _local.task = None
+
+
+class SubTask:
+    """
+    Part of a task (e.g. one segment of transfer), which can be stopped alone
+    """
+    def __init__(self, parent):
+        self.parent = parent
+        self.stopped = False
+
+    @property
+    def bulk(self):
+        return self.parent is not None and self.parent.bulk
+
+    @property
+    def cancelled(self):
+        return self.stopped or (self.parent is not None and self.parent.cancelled)
+
+    def cancel(self):
+        self.stopped = True
+
+    def report(self, done, size=None):
+        if self.parent is not None:
+            self.parent.report(done, size)
+
+
+class Task:
+    # bulk work (recursive transfers etc) gives way to interactive one
+    bulk = False
+
+    def __init__(self, fn, args, on_done, on_error):
+        self.fn = fn
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        return self.fn(*self.args)
+
+    def report(self, done, size=None):
+        """ Progress of transfer, made by task (bytes) """
+        pass
+
+    def report_files(self, done, count=None):
+        """ Progress of task, which handles many files """
+        pass
+
+
+class Engine:
+    """
+    Runs network work in background threads. CudaText API must be used only in
+    UI thread, so workers pass calls to UI via `post()` and `call_ui()`,
+    they are handled by timer in UI thread.
+    """
+
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cuda_ftp")
+        self.calls = queue.Queue()
+        self.tasks = set()
+        self.timer_on = False
+        self.closed = False
+
+    def submit(self, fn, *args, on_done=None, on_error=None):
+        """ Must be called in UI thread; callbacks are called in UI thread too """
+        return self.start(Task(fn, args, on_done, on_error))
+
+    def start(self, task, executor=None):
+        """ Run task by given executor (own one by default); UI thread only """
+        self.tasks.add(task)
+        self.start_timer()
+        task.future = (executor or self.executor).submit(self._run, task)
+        return task
+
+    def _run(self, task):
+        _local.task = task
+        try:
+            result = task.run()
+        except BaseException as ex:
+            self.post(self._finish, task, None, ex)
+        else:
+            self.post(self._finish, task, result, None)
+        finally:
+            _local.task = None
+
+    def _finish(self, task, result, ex):
+        self.tasks.discard(task)
+        if ex is None:
+            if task.on_done:
+                task.on_done(result)
+        elif task.on_error:
+            task.on_error(ex)
+
+    def post(self, fn, *args):
+        """ Call fn(*args) in UI thread later, don't wait """
+        self.calls.put((fn, args))
+        if is_main_thread():
+            self.start_timer()
+
+    def call_ui(self, fn, *args):
+        """ Call fn(*args) in UI thread and wait for result """
+        if is_main_thread():
+            return fn(*args)
+        if self.closed:
+            raise Cancelled("CudaText is closing")
+
+        done = threading.Event()
+        box = {}
+
+        def call():
+            try:
+                box["result"] = fn(*args)
+            except BaseException as ex:
+                box["error"] = ex
+            done.set()
+
+        box["done"] = done
+        call.box = box
+        self.post(call)
+        done.wait()
+        if "error" in box:
+            raise box["error"]
+        return box.get("result")
+
+    def cancel_all(self):
+        for task in list(self.tasks):
+            task.cancel()
+        return len(self.tasks)
+
+    def shutdown(self):
+        self.closed = True
+        self.cancel_all()
+        self.stop_timer()
+        # don't leave workers waiting for UI, which will not answer
+        while True:
+            try:
+                fn, args = self.calls.get_nowait()
+            except queue.Empty:
+                break
+            box = getattr(fn, "box", None)
+            if box is not None:
+                box["error"] = Cancelled("CudaText is closing")
+                box["done"].set()
+        self.executor.shutdown(wait=False)
+
+    def start_timer(self):
+        # workers post only while their task is not finished, so timer is on
+        if not self.timer_on:
+            self.timer_on = True
+            timer_proc(TIMER_START, self.on_timer, DISPATCH_INTERVAL)
+
+    def stop_timer(self):
+        if self.timer_on:
+            self.timer_on = False
+            timer_proc(TIMER_STOP, self.on_timer, 0)
+
+    def on_timer(self, tag='', info=''):
+        deadline = time.monotonic() + DISPATCH_BUDGET
+        while time.monotonic() < deadline:
+            try:
+                fn, args = self.calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+
+        if not self.tasks and self.calls.empty():
+            self.stop_timer()
+
+
+engine = Engine()
@@ -0,0 +1,208 @@
+import threading
+import time
+import contextlib
+from ftplib import Error as FTPError
+
+from .engine import current_task
+
+# errors, after which connection is still usable
+REPLY_ERRORS = (FTPError, FileNotFoundError, FileExistsError, PermissionError)
+
+
+def is_too_many_connections(ex):
+    """ FTP server refused connection, because there are too many of them """
+    if not isinstance(ex, FTPError):
+        return False
+    text = str(ex)
+    return text.startswith("421") or text.startswith("530") and "connection" in text.lower()
+
+
+class PoolEntry:
+    def __init__(self, client):
+        self.client = client
+        self.used = time.time()
+        self.probed = self.used
+        self.suspect = False
+
+
+class ConnectionPool:
+    """
+    Keeps authenticated clients alive between actions, keyed by server alias.
+
+    `connect(server)` must return a connected and logged in client.
+    Idle clients are closed after `idle_timeout` seconds, and probed with
+    NOOP every `keepalive` seconds (see `expire()`, called by timer).
+    Bulk tasks leave one connection for interactive ones (if limit is more than 1).
+    `server_limit(server)` gives limit of connections for server (None - default
+    `max_connections`); if server answers "too many connections", limit is
+    lowered to the count of open ones for `cap_timeout` seconds (other clients of
+    the same account can go away).
+    """
+
+    def __init__(self, connect, max_connections=4, idle_timeout=120, keepalive=30,
+            server_limit=None, cap_timeout=300):
+        self.connect = connect
+        self.max_connections = max_connections
+        self.server_limit = server_limit
+        self.cap_timeout = cap_timeout
+        self.caps = {}  # alias -> (limit, time), learned from server answers
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.lock = threading.Condition()
+        self.idle = {}  # alias -> [PoolEntry, ...]
+        self.busy = {}  # alias -> number of handed out (or connecting) clients
+
+    def limit(self, server):
+        limit = self.server_limit and self.server_limit(server) or self.max_connections
+        cap = self.caps.get(server.get("alias"))
+        if cap is None:
+            return limit
+        if time.time() - cap[1] > self.cap_timeout:
+            self.caps.pop(server.get("alias"), None)
+            return limit
+        return min(limit, cap[0])
+
+    def count(self, alias):
+        return self.busy.get(alias, 0) + len(self.idle.get(alias, ()))
+
+    def acquire(self, server, timeout=None):
+        alias = server.get("alias")
+        task = current_task()
+        bulk = task is not None and task.bulk
+        with self.lock:
+            while True:
+                idle = self.idle.get(alias)
+                if bulk and self.busy.get(alias, 0) >= max(1, self.limit(server) - 1):
+                    pass  # last connection is left for interactive work
+                elif idle:
+                    entry = idle.pop()
+                    break
+                elif self.count(alias) < self.limit(server):
+                    entry = None
+                    break
+                if not self.lock.wait(timeout):
+                    raise Exception("No free connection to '{}'".format(alias))
+            self.busy[alias] = self.busy.get(alias, 0) + 1
+
+        try:
+            if entry is not None:
+                if entry.suspect or time.time() - entry.probed > self.keepalive:
+                    if self.probe(entry):
+                        return entry.client
+                else:
+                    return entry.client
+            return self.connect(server)
+        except BaseException as ex:
+            with self.lock:
+                self.busy[alias] -= 1
+                self.lock.notify_all()
+                wait = is_too_many_connections(ex) and self.count(alias) > 0
+                if wait:
+                    # wait for one of our connections instead
+                    self.caps[alias] = (self.count(alias), time.time())
+            if wait:
+                return self.acquire(server, timeout)
+            raise
+
+    def release(self, server, client, broken=False, suspect=False):
+        alias = server.get("alias")
+        if broken:
+            self.close_client(client)
+        with self.lock:
+            self.busy[alias] -= 1
+            if not broken:
+                entry = PoolEntry(client)
+                entry.suspect = suspect
+                self.idle.setdefault(alias, []).append(entry)
+            self.lock.notify_all()
+
+    @contextlib.contextmanager
+    def client(self, server):
+        client = self.acquire(server)
+        try:
+            yield client
+        except REPLY_ERRORS:
+            # check the connection before giving it out again
+            self.release(server, client, broken=getattr(client, "dropped", False), suspect=True)
+            raise
+        except BaseException:
+            # timeout, dead socket, or transfer stopped in the middle
+            self.release(server, client, broken=True)
+            raise
+        else:
+            # client can drop connection itself, when its state is unknown
+            self.release(server, client, broken=getattr(client, "dropped", False))
+
+    def probe(self, entry):
+        try:
+            entry.client.noop()
+        except Exception:
+            self.close_client(entry.client)
+            return False
+        entry.probed = time.time()
+        entry.suspect = False
+        return True
+
+    def expire(self):
+        now = time.time()
+        to_close = []
+        to_probe = []
+        with self.lock:
+            for alias, entries in self.idle.items():
+                for entry in list(entries):
+                    if now - entry.used > self.idle_timeout:
+                        entries.remove(entry)
+                        to_close.append(entry)
+                    elif entry.suspect or now - entry.probed > self.keepalive:
+                        entries.remove(entry)
+                        to_probe.append((alias, entry))
+                        # still counted while probed
+                        self.busy[alias] = self.busy.get(alias, 0) + 1
+            if to_close:
+                self.lock.notify_all()
+
+        for entry in to_close:
+            self.close_client(entry.client)
+
+        for alias, entry in to_probe:
+            alive = self.probe(entry)
+            with self.lock:
+                self.busy[alias] -= 1
+                if alive:
+                    self.idle.setdefault(alias, []).append(entry)
+                self.lock.notify_all()
+
+    def take_all(self, alias=None):
+        """
+        Take idle clients out of the pool (of all servers, or of one), to close
+        them later
+        """
+        with self.lock:
+            if alias is None:
+                entries = [e for es in self.idle.values() for e in es]
+                self.idle.clear()
+            else:
+                entries = self.idle.pop(alias, [])
+                self.caps.pop(alias, None)
+            self.lock.notify_all()
+        return [entry.client for entry in entries]
+
+    def close_all(self, alias=None, quit=True):
+        """ QUIT waits for server answer, `quit=False` just closes sockets """
+        self.close_clients(self.take_all(alias), quit)
+
+    def close_clients(self, clients, quit=True):
+        for client in clients:
+            self.close_client(client, quit)
+
+    def close_client(self, client, quit=True):
+        if quit:
+            try:
+                client.quit()
+                return
+            except Exception:
+                pass
+        try:
+            client.close()
+        except Exception:
+            pass
@@ -0,0 +1,306 @@
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from .engine import engine, Task, SubTask, Cancelled
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def format_size(size):
+    for unit in ("b", "Kb", "Mb"):
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} Gb".format(size)
+
+
+class PriorityExecutor:
+    """
+    Thread pool, which runs interactive tasks before bulk ones (see `Task.bulk`).
+    Tasks of the same class are taken by turns for each server (`task.key`), so one
+    busy server doesn't hold back others, then in order of submitting.
+    Bulk tasks leave one thread for interactive ones (if there are more than 1).
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.threads = []
+        self.pending = []  # (bulk, number, fn, task, future)
+        self.running = {}  # key -> count of running tasks
+        self.started = {}  # key -> number of last started task
+        self.bulk_running = 0
+        self.counter = itertools.count()
+        self.lock = threading.Condition()
+        self.closed = False
+
+    def submit(self, fn, task):
+        future = Future()
+        with self.lock:
+            self.pending.append((task.bulk, next(self.counter), fn, task, future))
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.worker, name="cuda_ftp_transfer", daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            # waiting thread can be one, which doesn't take bulk tasks now
+            self.lock.notify_all()
+        return future
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while True:
+                    item = self.next_item()
+                    if item is not None or self.closed and not self.pending:
+                        break
+                    self.lock.wait()
+                if item is None:
+                    return
+                self.pending.remove(item)
+                bulk, number, fn, task, future = item
+                self.running[task.key] = self.running.get(task.key, 0) + 1
+                self.started[task.key] = number
+                self.bulk_running += bulk
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(task))
+                    except BaseException as ex:
+                        future.set_exception(ex)
+            finally:
+                with self.lock:
+                    self.running[task.key] -= 1
+                    self.bulk_running -= bulk
+                    self.lock.notify_all()
+
+    def next_item(self):
+        if self.bulk_running < max(1, self.workers - 1):
+            items = self.pending
+        else:
+            # last thread is left for interactive work
+            items = [item for item in self.pending if not item[0]]
+        return min(items, key=self.order) if items else None
+
+    def order(self, item):
+        bulk, number, _x, task, _xx = item
+        return bulk, self.running.get(task.key, 0), self.started.get(task.key, -1), number
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+
+class Transfer(Task):
+    """
+    Item of transfer queue: task with state and progress
+    """
+
+    def __init__(self, title, fn, args, on_done, on_error, bulk=False, key=None):
+        super().__init__(fn, args, on_done, on_error)
+        self.title = title
+        self.bulk = bulk
+        self.key = key
+        self.state = QUEUED
+        self.error = None
+        self.size = None
+        self.done = 0
+        self.first_done = None
+        self.files = None
+        self.files_done = 0
+        self.started = None
+        self.finished = None
+        # called by "Retry" instead of adding the same task again
+        self.on_retry = None
+
+    def run(self):
+        if self.cancelled:
+            self.state = CANCELLED
+            raise Cancelled("Stopped by user")
+        self.state = RUNNING
+        self.started = time.monotonic()
+        try:
+            result = super().run()
+        except Cancelled:
+            self.state = CANCELLED
+            raise
+        except BaseException as ex:
+            self.state = FAILED
+            self.error = str(ex)
+            raise
+        else:
+            self.state = DONE
+            return result
+        finally:
+            self.finished = time.monotonic()
+
+    def report(self, done, size=None):
+        if self.first_done is None:
+            # resumed transfer starts not from 0
+            self.first_done = done
+        self.done = done
+        if size is not None:
+            self.size = size
+
+    def report_files(self, done, count=None):
+        self.files_done = done
+        if count is not None:
+            self.files = count
+
+    def files_speed(self):
+        if self.started is None:
+            return None
+        elapsed = (self.finished or time.monotonic()) - self.started
+        if elapsed <= 0:
+            return None
+        return self.files_done / elapsed
+
+    def speed(self):
+        if self.started is None or self.first_done is None:
+            return None
+        elapsed = (self.finished or time.monotonic()) - self.started
+        if elapsed <= 0:
+            return None
+        return (self.done - self.first_done) / elapsed
+
+    def eta(self):
+        speed = self.speed()
+        if not speed or self.size is None or self.state != RUNNING:
+            return None
+        return (self.size - self.done) / speed
+
+    def describe(self):
+        text = "[{}] {}{}".format(self.state, "(bulk) " if self.bulk else "", self.title)
+        if self.files is not None:
+            text += ": {} of {} files".format(self.files_done, self.files)
+            files_speed = self.files_speed()
+            if files_speed:
+                text += " ({:.1f} files/s)".format(files_speed)
+        if self.size is not None:
+            text += ": {} of {}".format(format_size(self.done), format_size(self.size))
+        elif self.done:
+            text += ": {}".format(format_size(self.done))
+        speed = self.speed()
+        if speed:
+            text += ", {}/s".format(format_size(speed))
+        eta = self.eta()
+        if eta is not None:
+            text += ", ETA {}:{:02}".format(int(eta) // 60, int(eta) % 60)
+        if self.error:
+            text += " - " + self.error
+        return text
+
+
+class Batch:
+    """
+    Progress of transfer of many files (dir download etc): each file is handled
+    by its own item (sub-task), their progress is summed up for `transfer`
+    """
+
+    def __init__(self, transfer):
+        self.transfer = transfer
+        self.lock = threading.Lock()
+        self.size = 0
+        self.files = 0
+        self.done = 0  # bytes of finished files
+        self.files_done = 0
+        self.items = set()
+
+    def add(self, files=1, size=0):
+        with self.lock:
+            self.files += files
+            self.size += size
+            self.update()
+
+    def advance(self, files=1):
+        """ Files are handled without items (e.g. removed) """
+        with self.lock:
+            self.files_done += files
+            self.update()
+
+    def item(self):
+        item = BatchItem(self)
+        with self.lock:
+            self.items.add(item)
+        return item
+
+    def finish(self, item):
+        with self.lock:
+            self.items.discard(item)
+            self.done += item.done
+            self.files_done += 1
+            self.update()
+
+    def update(self):
+        if self.transfer is None:
+            return
+        self.transfer.report(self.done + sum(i.done for i in self.items), self.size)
+        self.transfer.report_files(self.files_done, self.files)
+
+
+class BatchItem(SubTask):
+    def __init__(self, batch):
+        super().__init__(batch.transfer)
+        self.batch = batch
+        self.done = 0
+
+    def report(self, done, size=None):
+        with self.batch.lock:
+            self.done = done
+            self.batch.update()
+
+
+class TransferQueue:
+    """
+    Downloads and uploads, run by `workers` threads (they take connections from
+    the pool). Interactive transfers go before bulk ones. Finished items are kept
+    to be shown, up to `keep_finished`.
+    """
+
+    def __init__(self, workers=4, keep_finished=100):
+        self.executor = PriorityExecutor(workers)
+        self.keep_finished = keep_finished
+        self.items = []
+        self.lock = threading.Lock()
+
+    def add(self, title, fn, *args, on_done=None, on_error=None, bulk=False, key=None):
+        """
+        Must be called in UI thread; callbacks are called in UI thread too.
+        `key` is server alias, transfers of different servers are run by turns.
+        """
+        transfer = Transfer(title, fn, args, on_done, on_error, bulk, key)
+        with self.lock:
+            self.items.append(transfer)
+            finished = [t for t in self.items if t.state in (DONE, FAILED, CANCELLED)]
+            for t in finished[:len(finished) - self.keep_finished]:
+                self.items.remove(t)
+        return engine.start(transfer, self.executor)
+
+    def retry(self, transfer):
+        if transfer.on_retry is not None:
+            return transfer.on_retry()
+        return self.add(transfer.title, transfer.fn, *transfer.args,
+            on_done=transfer.on_done, on_error=transfer.on_error, bulk=transfer.bulk,
+            key=transfer.key)
+
+    def active(self):
+        with self.lock:
+            return [t for t in self.items if t.state in (QUEUED, RUNNING)]
+
+    def clear_finished(self):
+        with self.lock:
+            self.items = [t for t in self.items if t.state in (QUEUED, RUNNING)]
+
+    def describe(self):
+        with self.lock:
+            return [t.describe() for t in self.items]
+
+    def shutdown(self):
+        for transfer in self.active():
+            transfer.cancel()
+        self.executor.shutdown()